@@ -9,3 +9,19 @@ session "cdcron" {
 key "service/cdcron/leader" {
     policy = "write"
 }
+
+key_prefix "service/cdcron/shards/" {
+    policy = "write"
+}
+
+key_prefix "service/cdcron/checkpoints/" {
+    policy = "write"
+}
+
+node_prefix "" {
+    policy = "read"
+}
+
+key_prefix "service/cdcron/workload/" {
+    policy = "read"
+}
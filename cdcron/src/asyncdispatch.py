@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+
+import checkpoint
+import dispatch
+import limits
+import metrics
+import tracing
+from breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Errors of connection to target or of its response, others come from job definition or this instance
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class AsyncDispatcher:
+    """Runs HTTP jobs as coroutines on a single event loop in a background thread"""
+
+    def __init__(self):
+        # Read env variables
+        self.concurrency = int(os.getenv("ASYNC_CONCURRENCY", 1000))
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._semaphore = None
+        self._session = None
+        self.limits = limits.Limits()  # Touched only from loop thread
+        self.paused = False
+        self.generation = 0  # Incremented on every pause
+        self._tasks = set()  # Requests in flight, including ones waiting for limits or retry
+
+    def start(self):
+        """Start event loop thread and open shared client session"""
+
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+        logger.info(f"asyncio dispatcher started with concurrency limit {self.concurrency}")
+
+    async def _open(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(
+            limit=0,  # Global limit is enforced by semaphore
+            limit_per_host=0,  # Per host concurrency is up to limits of workload
+            force_close=not dispatch.sessions.keepalive,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+
+    @staticmethod
+    def _trace_config():
+        """Hooks adding time spent waiting for pooled connection, resolving and connecting to trace of job run
+
+        aiohttp opens TCP and TLS in one step, so TLS handshake is counted in connect phase.
+        """
+
+        def timed(config, start, end, phase):
+            async def on_start(session, context, params):
+                setattr(context, phase, time.monotonic())
+
+            async def on_end(session, context, params):
+                trace = context.trace_request_ctx
+                elapsed = time.monotonic() - getattr(context, phase)
+                if phase == "dns":
+                    context.resolved = elapsed  # Resolving happens while connection is created
+                elif phase == "connect":
+                    elapsed -= getattr(context, "resolved", 0.0)
+                if trace is not None:
+                    trace.add(phase, elapsed)
+
+            getattr(config, start).append(on_start)
+            getattr(config, end).append(on_end)
+
+        config = aiohttp.TraceConfig()
+        timed(config, "on_connection_queued_start", "on_connection_queued_end", "queue")
+        timed(config, "on_connection_create_start", "on_connection_create_end", "connect")
+        timed(config, "on_dns_resolvehost_start", "on_dns_resolvehost_end", "dns")
+        return config
+
+    def pause(self, cancel=False):
+        """Stop starting requests, waiting ones are dropped, ones in flight are left to finish or cancelled"""
+
+        self.paused = True
+        self.generation += 1
+        if cancel:
+            self.loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def resume(self):
+        self.paused = False
+
+    def saturation(self):
+        """Share of concurrency limit in use"""
+
+        return metrics.in_flight.active / self.concurrency
+
+    def shutdown(self, wait=True):
+        """Stop dispatcher, waiting for requests in flight first if wait"""
+
+        if wait and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.stop()
+
+    async def _drain(self):
+        if self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def stop(self):
+        """Close client session and stop event loop"""
+
+        if self._session and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def configure(self, config):
+        """Apply limits from workload on loop thread"""
+
+        self.loop.call_soon_threadsafe(self._configure, config)
+
+    def _configure(self, config):
+        self.limits.configure(config)
+        for limit in self.limits:
+            self._wake(limit)
+
+    def _wake(self, limit):
+        """Let as many parked coroutines as limit has free slots recheck it, they park again if it is full"""
+
+        free = len(limit.waiting) if limit.concurrency is None else limit.concurrency - limit.active
+        while limit.waiting and free > 0:
+            waiter = limit.waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def _acquire(self, task):
+        """Wait for rate limit tokens and concurrency slots of task, sleeping instead of holding a thread"""
+
+        task_limits = self.limits.for_task(task)
+        delay = max([limit.reserve(time.monotonic()) for limit in task_limits], default=0)
+        if delay > 0:
+            metrics.deferred_jobs.inc("rate")
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                metrics.deferred_jobs.dec("rate")
+
+        while True:
+            full = next((limit for limit in task_limits if limit.full()), None)
+            if full is None:
+                break
+            waiter = self.loop.create_future()
+            full.waiting.append(waiter)
+            metrics.deferred_jobs.inc("concurrency")
+            try:
+                await waiter
+            finally:
+                metrics.deferred_jobs.dec("concurrency")
+
+        for limit in task_limits:
+            limit.active += 1
+        return task_limits
+
+    def _release(self, task_limits):
+        for limit in task_limits:
+            limit.active -= 1
+            self._wake(limit)
+
+    def submit(self, method, task, planned=None):
+        """Start request of job run planned at datetime as coroutine on loop, callable from any thread"""
+
+        asyncio.run_coroutine_threadsafe(self.request(method, task, planned), self.loop)
+
+    async def request(self, method, task, planned=None):
+        """Execute HTTP request described by task, retrying failures after backoff without blocking the loop"""
+
+        if self.paused:
+            metrics.schedule.discarded(task.get("id"), planned)
+            return
+        current = asyncio.current_task()
+        self._tasks.add(current)
+        try:
+            await self._retry(method, task, self.generation, planned)
+        except asyncio.CancelledError:
+            metrics.job_executions.inc(task.get("id", task["url"]), "cancelled")
+            logger.info(f"job {task.get('id')} cancelled")
+        finally:
+            self._tasks.discard(current)
+
+    async def _retry(self, method, task, generation, planned):
+        attempt = 0
+        while True:
+            try:
+                status_code = await self._attempt(method, task, attempt, generation, planned)
+                if not dispatch.failed(status_code):
+                    checkpoint.succeeded(task, planned)
+            except CircuitOpenError as e:
+                logger.warning(f"job {task.get('id')} skipped: {e}")
+                return
+            except dispatch.RequestCancelled as e:
+                logger.info(f"job {task.get('id')} cancelled: {e}")
+                return
+            except Exception as e:
+                logger.error(f"job {task.get('id')} failed: {e}")
+                status_code = None
+            attempt += 1
+            delay = dispatch.retry_delay(task, attempt) if dispatch.failed(status_code) else None
+            if delay is None or self.generation != generation:
+                return
+            logger.info(f"job {task.get('id')} will be retried in {delay:.1f}s, attempt {attempt}")
+            metrics.deferred_jobs.inc("retry")
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                metrics.deferred_jobs.dec("retry")
+
+    async def _attempt(self, method, task, attempt, generation, planned):
+        """Send request once within limits, reading only first bytes of body, returns status code"""
+
+        connect_timeout, read_timeout = dispatch.sessions.timeout(task)
+        kwargs = {"timeout": aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)}
+        if method in dispatch.BODY_METHODS:
+            kwargs["json"] = task.get("data", {})
+
+        limit = dispatch.body_limit(task)
+        trace = tracing.Trace(task)
+        try:
+            task_limits = await self._acquire(task)
+        except asyncio.CancelledError:
+            if attempt == 0:
+                metrics.schedule.discarded(task.get("id"), planned)  # Cancelled while waiting for limits
+            raise
+        try:
+            if self.generation != generation:
+                if attempt == 0:
+                    metrics.schedule.discarded(task.get("id"), planned)
+                return None  # Dispatcher was paused while request waited for limits
+            if attempt == 0:
+                metrics.schedule.started(task.get("id"), planned)
+            with tracing.traced(trace):
+                return await self._send(method, task, kwargs, limit, trace)
+        finally:
+            self._release(task_limits)
+
+    async def _send(self, method, task, kwargs, limit, trace):
+        async with self._semaphore:
+            trace.dequeued()
+            kwargs["headers"] = dispatch.headers(task, dispatch.fence(task))
+            breaker = dispatch.allow(task)
+            started = time.monotonic()
+            metrics.in_flight.started()
+            try:
+                trace.sending()
+                async with self._session.request(method, task["url"], trace_request_ctx=trace, **kwargs) as response:
+                    trace.received()
+                    body = b""
+                    if limit:
+                        try:
+                            body = await response.content.readexactly(limit + 1)
+                        except asyncio.IncompleteReadError as e:
+                            body = e.partial
+                    if not response.content.at_eof() and dispatch.drainable(response.content_length):
+                        while await response.content.readany():
+                            pass  # Small rest of body is read, so connection goes back to pool
+                    trace.read()
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release()
+                raise
+            except Exception as e:
+                transport = isinstance(e, TRANSPORT_ERRORS)
+                dispatch.record(method, task, None, time.monotonic() - started, dispatch.blamed(breaker, transport))
+                raise
+            finally:
+                metrics.in_flight.finished()
+            dispatch.record(method, task, response.status, time.monotonic() - started, breaker)
+
+        dispatch.log_response(method, task, response.status, body, limit)
+        return response.status
@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: "closed", HALF_OPEN: "half-open", OPEN: "open"}
+
+
+class CircuitOpenError(Exception):
+    """Request was not sent because circuit of its target host is open"""
+
+
+class CircuitBreaker:
+    """Circuit of one target host
+
+    Opens after threshold consecutive failures and rejects requests until reset timeout passes,
+    then lets one probe request through in half-open state. Probe success closes circuit,
+    failure or no result within reset timeout opens it again.
+    """
+
+    def __init__(self, host, threshold, reset_timeout):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.probing = None  # Start of probe request in flight in half-open state
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            log = logger.warning if state == OPEN else logger.info
+            log(f"circuit of {self.host} is {STATE_NAMES[state]}")
+            self.state = state
+            metrics.circuit_state.set(state, self.host)
+
+    def allow(self):
+        """True if request may be sent, only one caller gets through while circuit is half-open"""
+
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == HALF_OPEN and self.probing is None:
+                self.probing = now  # Previous probe was cancelled
+                return True
+            if self.state == HALF_OPEN and now - self.probing >= self.reset_timeout:
+                self.opened = now
+                self._set_state(OPEN)  # Probe never reported its result
+            elif self.state == OPEN and now - self.opened >= self.reset_timeout:
+                self.probing = now
+                self._set_state(HALF_OPEN)
+                return True
+            return False
+
+    def release(self):
+        """Give back slot of allowed request that was cancelled, so it doesn't hold half-open circuit"""
+
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probing = None
+
+    def record(self, success):
+        """Record result of request that was allowed"""
+
+        with self._lock:
+            if success:
+                self.failures = 0
+                self._set_state(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+                self._set_state(OPEN)
+
+
+class Breakers:
+    """Circuit breakers keyed by target host"""
+
+    def __init__(self):
+        # Read env variables
+        self.threshold = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+        self.reset_timeout = float(os.getenv("BREAKER_RESET_TIMEOUT", 30))
+
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Return breaker of target host of url, None if breakers are disabled"""
+
+        if self.threshold <= 0:
+            return None
+        host = urlsplit(url).netloc
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(host, CircuitBreaker(host, self.threshold, self.reset_timeout))
+        return breaker
@@ -4,115 +4,170 @@ import json
 import logging
 import os
 import sys
+import threading
 import time
+from functools import partial
 
-import requests
+from apscheduler.events import EVENT_JOB_MISSED, JobExecutionEvent
+from apscheduler.executors.base import BaseExecutor
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+from apscheduler.schedulers.base import BaseScheduler
+
+import checkpoint
+import cronheap
+import dispatch
+import executor
+import health
+import joblog
+import metrics
+import workload
+from shard import shard_of
 
 logger = logging.getLogger(__name__)
 apscheduler_logger = logging.getLogger("apscheduler")
 apscheduler_logger.setLevel(logging.CRITICAL)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    handlers=[logging.StreamHandler()],
-)
+joblog.configure()
 
 
-def http_get(task):
-    headers = task.get("headers", {})
-    response = requests.get(task["url"], headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"GET {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"GET {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+http_methods = {
+    "GET": partial(dispatch.request, "GET"),
+    "HEAD": partial(dispatch.request, "HEAD"),
+    "OPTIONS": partial(dispatch.request, "OPTIONS"),
+    "TRACE": partial(dispatch.request, "TRACE"),
+    "PUT": partial(dispatch.request, "PUT"),
+    "DELETE": partial(dispatch.request, "DELETE"),
+    "POST": partial(dispatch.request, "POST"),
+    "PATCH": partial(dispatch.request, "PATCH"),
+}
 
 
-def http_head(task):
-    headers = task.get("headers", {})
-    response = requests.head(task["url"], headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"HEAD {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"HEAD {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+class HandoverExecutor(BaseExecutor):
+    """APScheduler executor calling job function in scheduler thread, with fire time of run as 'planned'
 
+    Job functions only hand runs over to job executor or event loop, so they need no pool of their own,
+    and every run carries fire time it was planned for.
+    """
 
-def http_options(task):
-    headers = task.get("headers", {})
-    response = requests.options(task["url"], headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"OPTIONS {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"OPTIONS {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+    def submit_job(self, job, run_times):
+        """Hand runs over right away, handover doesn't wait for run, so max instances are not counted"""
 
+        self._do_submit_job(job, run_times)
 
-def http_trace(task):
-    headers = task.get("headers", {})
-    response = requests.request("TRACE", task["url"], headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"TRACE {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"TRACE {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+    def _do_submit_job(self, job, run_times):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for run_time in run_times:
+            if job.misfire_grace_time is not None and (now - run_time).total_seconds() > job.misfire_grace_time:
+                self._scheduler._dispatch_event(JobExecutionEvent(EVENT_JOB_MISSED, job.id, job._jobstore_alias, run_time))
+                continue
+            metrics.schedule.submitted(job.id, run_time)
+            try:
+                job.func(*job.args, planned=run_time, **job.kwargs)
+            except Exception as e:
+                logger.error(f"job {job.id} failed: {e}")
 
 
-def http_put(task):
-    headers = task.get("headers", {})
-    response = requests.put(task["url"], json=task.get("data", {}), headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"PUT {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"PUT {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+def build_scheduler():
+    """Create scheduler for configured executor mode, returns scheduler, job table and executor enforcing limits"""
 
+    executor_mode = os.getenv("EXECUTOR_MODE", "thread").lower()
+    scheduler_core = os.getenv("SCHEDULER_CORE", "apscheduler").lower()
+    job_defaults = {"misfire_grace_time": int(os.getenv("MISFIRE_GRACE_TIME", 1))}
+    executors = {"default": HandoverExecutor()}
 
-def http_delete(task):
-    headers = task.get("headers", {})
-    response = requests.delete(task["url"], headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"DELETE {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"DELETE {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+    if executor_mode == "asyncio":
+        import asyncdispatch
 
+        dispatcher = asyncdispatch.AsyncDispatcher()
+        dispatcher.start()
+        atexit.register(dispatcher.stop)
+        scheduler = AsyncIOScheduler(event_loop=dispatcher.loop, executors=executors, job_defaults=job_defaults)
+        methods = {method: partial(dispatcher.submit, method) for method in http_methods}
+        return scheduler, methods, dispatcher
 
-def http_post(task):
-    headers = task.get("headers", {})
-    response = requests.post(task["url"], json=task.get("data", {}), headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"POST {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+    if executor_mode == "process":
+        import procpool
+
+        # Executor workers only wait for requests sent from worker processes
+        job_executor = procpool.ProcessExecutor()
+        funcs = {method: partial(job_executor.request, method) for method in http_methods}
+    elif executor_mode == "thread":
+        job_executor = executor.JobExecutor()
+        funcs = http_methods
     else:
-        logger.info(f"POST {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+        logger.error(f"unknown EXECUTOR_MODE '{executor_mode}', expected 'thread', 'asyncio' or 'process'")
+        os._exit(1)
 
+    # Scheduler workers only hand jobs over to executor, requests run on executor workers
+    atexit.register(job_executor.shutdown, wait=False)
+    methods = {method: partial(job_executor.submit, func) for method, func in funcs.items()}
 
-def http_patch(task):
-    headers = task.get("headers", {})
-    response = requests.patch(task["url"], json=task.get("data", {}), headers=headers)
-    if 400 <= response.status_code < 600:
-        logger.warning(f"PATCH {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
-    else:
-        logger.info(f"PATCH {task['url']} - Status Code: {response.status_code} - Response: {response.content}")
+    if scheduler_core == "heap":
+        workers = int(os.getenv("SCHEDULER_WORKERS", 10))
+        scheduler = cronheap.HeapScheduler(max_workers=workers, misfire_grace_time=job_defaults["misfire_grace_time"])
+        return scheduler, methods, job_executor
+    elif scheduler_core != "apscheduler":
+        logger.error(f"unknown SCHEDULER_CORE '{scheduler_core}', expected 'apscheduler' or 'heap'")
+        os._exit(1)
 
+    scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+    return scheduler, methods, job_executor
+
+
+def track_scheduler_event(event):
+    """Scheduler listener feeding misfire metrics, runs handed over are recorded by HandoverExecutor"""
+
+    if event.code == EVENT_JOB_MISSED:
+        if event.scheduled_run_time.timestamp() >= metrics.schedule.active_since:
+            metrics.misfires.inc(event.job_id, "missed")
+
+
+def sync_jobs(scheduler, methods, scheduled, jobs):
+    """Bring scheduler in line with jobs, touching only jobs that were added, removed or changed
+
+    Returns jobs that are scheduled now.
+    """
+
+    for key in scheduled.keys() - jobs.keys():
+        scheduler.remove_job(key)
+        logger.info(f"Removed {scheduled[key].method} request to {scheduled[key].task['url']}")
+
+    for key, job in jobs.items():
+        current = scheduled.get(key)
+        if current is None:
+            scheduler.add_job(methods[job.method], job.trigger, args=[job.task], id=key)
+            logger.info(f"Scheduled {job.method} request to {job.task['url']} with cron '{job.task['cron']}'")
+        elif current.fingerprint != job.fingerprint:
+            scheduler.modify_job(key, func=methods[job.method], args=[job.task])
+            if current.task["cron"] != job.task["cron"] or current.offset != job.offset:
+                scheduler.reschedule_job(key, trigger=job.trigger)
+            logger.info(f"Updated {job.method} request to {job.task['url']} with cron '{job.task['cron']}'")
+
+    return dict(jobs)
 
-http_methods = {
-    "GET": http_get,
-    "HEAD": http_head,
-    "OPTIONS": http_options,
-    "TRACE": http_trace,
-    "PUT": http_put,
-    "DELETE": http_delete,
-    "POST": http_post,
-    "PATCH": http_patch,
-}
 
+def owned_jobs(jobs, consul):
+    """Jobs this instance should run, in sharded mode only jobs of owned shards"""
 
-def cdcron():
-    logger.info(f"Current timezone is {datetime.datetime.now().astimezone().strftime("%Z (%z)")}")
-    scheduler = BackgroundScheduler()
+    if consul is None or not consul.sharded:
+        return jobs
+    return {key: job for key, job in jobs.items() if shard_of(key, consul.shard_count) in consul.owned_shards}
+
+
+def load_workload(consul=None):
+    """Load WORKLOAD_FILE into cache of compiled jobs, followers keep it up to date for takeover"""
+
+    workloadfile = os.getenv("WORKLOAD_FILE", os.path.join(sys.path[0], "workload.json"))
+    reload = os.getenv("WORKLOAD_RELOAD", "false").lower() == "true"
 
     try:
-        workloadfile = os.getenv("WORKLOAD_FILE", os.path.join(sys.path[0], "workload.json"))
-        with open(workloadfile, encoding="utf=8") as f:
-            workload = json.load(f)
+        if workloadfile.startswith("consul://"):
+            if consul is None:
+                raise Exception(f"{workloadfile} can be used only with consul client")
+            watcher = workload.ConsulWatcher(consul, workloadfile[len("consul://") :], http_methods)
+            return workload.WorkloadCache(watcher, watch=True)
+        return workload.WorkloadCache(workload.FileWatcher(workloadfile, http_methods), watch=reload)
     except json.decoder.JSONDecodeError:
         logger.error(f"{workloadfile} is not an JSON file")
         os._exit(1)
@@ -123,18 +178,142 @@ def cdcron():
         logger.error(f"{e}")
         os._exit(1)
 
-    for task in workload:
-        method = task["method"].upper()
-        if method in http_methods:
-            trigger = CronTrigger.from_crontab(task["cron"])
-            scheduler.add_job(http_methods[method], trigger, args=[task])
-            logger.info(f"Scheduled {method} request to {task['url']} with cron '{task['cron']}'")
+
+def skip_missed(scheduler, grace):
+    """Move next run time of paused APScheduler jobs to first fire time within grace seconds
+
+    Paused APScheduler keeps next run times where they were and on resume would compute every fire time
+    missed meanwhile one by one. Heap core skips missed fire times on resume itself.
+    """
+
+    if not isinstance(scheduler, BaseScheduler):
+        return
+    horizon = datetime.datetime.now(scheduler.timezone) - datetime.timedelta(seconds=grace)
+    fire_times = {}  # Jobs with identical crontab share trigger
+    for job in scheduler.get_jobs():
+        if job.next_run_time is None or job.next_run_time >= horizon:
+            continue
+        if id(job.trigger) not in fire_times:
+            fire_times[id(job.trigger)] = job.trigger.get_next_fire_time(None, horizon)
+        scheduler.modify_job(job.id, next_run_time=fire_times[id(job.trigger)])
+
+
+def keep_warm(cache, consul, interval, warm=dispatch.sessions.warm):
+    """Thread to keep connection pools of follower open, so new leader sends first requests without handshakes"""
+
+    while True:
+        if not consul.is_leader:
+            warm(job.task["url"] for job in list(cache.jobs.values()))
+        time.sleep(interval)
+
+
+def catch_up(jobs, known, methods, until):
+    """Thread to dispatch runs of jobs missed before until while no instance scheduled them"""
+
+    def submit(job, planned):
+        methods[job.method](job.task, planned=planned)
+
+    dispatched = checkpoint.catch_up(jobs, known, submit, until)
+    if dispatched:
+        logger.info(f"Dispatched {dispatched} missed runs")
+
+
+def cdcron(cache=None, consul=None, standby=False):
+    """Schedule jobs of cache and keep scheduler in sync with it
+
+    In leader mode dispatch is paused as soon as leadership is lost. With standby, scheduler is
+    built paused, resumed when this instance becomes leader and never returns. Without standby,
+    scheduler is stopped and function returns after leadership is lost.
+    """
+
+    logger.info(f"Current timezone is {datetime.datetime.now().astimezone().strftime('%Z (%z)')}")
+    if cache is None:
+        cache = load_workload(consul)
+    scheduler, methods, job_executor = build_scheduler()
+    if isinstance(scheduler, BaseScheduler):
+        scheduler.add_listener(track_scheduler_event, EVENT_JOB_MISSED)
+    sharded = consul is not None and consul.sharded
+    elected = consul is not None and not consul.sharded
+    cancel = os.getenv("DEMOTION_POLICY", "drain").lower() == "cancel"
+    grace = int(os.getenv("MISFIRE_GRACE_TIME", 1))
+    if consul is not None:
+        dispatch.fencing_token = consul.fencing_token
+        if checkpoint.store is None:
+            checkpoint.store = checkpoint.CheckpointStore(consul)
+
+    def start_catch_up(jobs, until):
+        if checkpoint.store is not None and jobs:
+            args = (jobs, list(cache.jobs), methods, until)
+            threading.Thread(target=catch_up, args=args, daemon=True).start()
+
+    jobs = cache.jobs
+    job_executor.configure(cache.limits)
+    scheduled = sync_jobs(scheduler, methods, {}, owned_jobs(jobs, consul))
+    started = time.time()  # Runs planned before scheduler started are left to catch-up
+    scheduler.start(paused=standby)
+    logger.info("Scheduler started paused, waiting for leadership..." if standby else "Scheduler started...")
+    if not standby:
+        health.saturation = job_executor.saturation
+        start_catch_up(scheduled, started)
+
+    def on_leadership_change(is_leader):
+        if is_leader:
+            metrics.schedule.took_over()
+            health.saturation = job_executor.saturation
+            job_executor.resume()
+            # Scheduler itself runs only runs that came due within misfire grace time while it was paused
+            until = time.time() - grace
+            skip_missed(scheduler, grace)
+            scheduler.resume()
+            logger.info("Scheduler resumed, this instance is the leader")
+            start_catch_up(owned_jobs(cache.jobs, consul), until)
         else:
-            logger.warning(f"Method '{method}' not supported for task: {task}")
+            started = time.monotonic()
+            scheduler.pause()
+            job_executor.pause(cancel=cancel)
+            metrics.demotion_duration.set(time.monotonic() - started)
+            logger.info(f"Scheduler paused in {(time.monotonic() - started) * 1000:.1f} ms, this instance is a follower")
 
-    scheduler.start()
-    logger.info("Scheduler started...")
+    if elected:
+        # Standby scheduler was started paused and active one running, change since then is delivered once
+        consul.on_leadership_change(on_leadership_change, since=not standby)
+    if standby:
+        warm_interval = float(os.getenv("WARM_INTERVAL", 30))
+        warm = getattr(job_executor, "warm", dispatch.sessions.warm)  # Worker processes keep their own pools
+        threading.Thread(target=keep_warm, args=(cache, consul, warm_interval, warm), daemon=True).start()
     atexit.register(scheduler.shutdown)
+    atexit.register(dispatch.sessions.close)
 
     while True:
-        time.sleep(1)
+        changed = False
+        if not sharded:
+            changed = cache.changed.wait(timeout=1)
+        elif consul.shards_changed.wait(timeout=1):
+            consul.shards_changed.clear()
+            changed = True
+            if not consul.owned_shards:
+                # All shards were lost, e.g. when session was not renewed in time, so runs in flight are treated as on demotion
+                job_executor.pause(cancel=cancel)
+                job_executor.resume()
+
+        if elected and not standby and not consul.is_leader:
+            consul.off_leadership_change(on_leadership_change)
+            scheduler.shutdown(wait=False)
+            atexit.unregister(scheduler.shutdown)
+            job_executor.shutdown(wait=not cancel)
+            metrics.schedule.clear()  # Runs abandoned by stopped executor, e.g. coroutines left on stopped loop
+            logger.info("Scheduler stopped, this instance is no longer the leader")
+            return
+
+        if cache.changed.is_set():
+            cache.changed.clear()
+            jobs = cache.jobs
+            job_executor.configure(cache.limits)
+            changed = True
+
+        if changed:
+            previous, until = scheduled, time.time()
+            scheduled = sync_jobs(scheduler, methods, scheduled, owned_jobs(jobs, consul))
+            logger.info(f"Scheduling {len(scheduled)} of {len(jobs)} jobs")
+            if sharded:
+                start_catch_up({key: job for key, job in scheduled.items() if key not in previous}, until)
@@ -0,0 +1,217 @@
+import atexit
+import base64
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+from consul import TXN_MAX_OPERATIONS
+from shard import shard_of
+
+logger = logging.getLogger(__name__)
+
+# Default catch-up policy of jobs: skip, once or number of latest missed runs to dispatch
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "skip")
+
+# Missed runs planned longer than this many seconds ago are never caught up
+CATCHUP_MAX_AGE = float(os.getenv("CATCHUP_MAX_AGE", 86400))
+
+# Checkpoint store of this instance, set when scheduling under consul locks
+store = None
+
+
+def policy(task):
+    """Catch-up policy of task, 0 to skip missed runs, otherwise max number of missed runs to dispatch"""
+
+    value = str(task.get("catchup", CATCHUP_POLICY)).lower()
+    if value == "skip":
+        return 0
+    if value == "once":
+        return 1
+    if value.isdigit():
+        return int(value)
+    raise ValueError(f"catch-up policy must be 'skip', 'once' or number of runs: {value}")
+
+
+def missed(trigger, since, until, limit):
+    """Latest limit fire times of trigger after timestamp since and before timestamp until"""
+
+    fire_times = collections.deque(maxlen=limit)
+    moment = datetime.datetime.fromtimestamp(max(since, until - CATCHUP_MAX_AGE), trigger.timezone)
+    while True:
+        moment = trigger.get_next_fire_time(moment, moment)
+        if moment is None or moment.timestamp() >= until:
+            return list(fire_times)
+        if moment.timestamp() > since:
+            fire_times.append(moment)
+
+
+def succeeded(task, planned):
+    """Record successful run of task planned at datetime, runs without planned time are not recorded"""
+
+    if store is not None and planned is not None:
+        store.record(task.get("id"), planned.timestamp())
+
+
+class CheckpointStore:
+    """Planned time of last successful run of every job, kept in consul KV
+
+    Jobs are split into buckets the same way as into shards, every bucket is one KV key with
+    checkpoints of its jobs. Runs only mark their bucket dirty, dirty buckets are written together
+    every interval in transactions that check this instance still holds the lock of bucket, so
+    demoted leader can't overwrite checkpoints of its successor.
+    """
+
+    def __init__(self, consul):
+        # Read env variables
+        self.interval = float(os.getenv("CHECKPOINT_INTERVAL", 5))
+
+        self.consul = consul
+        self.prefix = f"service/{consul.service_name}/checkpoints/"
+        self._buckets = collections.defaultdict(dict)  # Bucket number to job IDs and timestamps
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.run_flush, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)  # Registered after consul client, so runs before locks are released
+        consul.on_shards_release(lambda shards: self.flush())
+
+    def bucket(self, job_id):
+        return shard_of(job_id, self.consul.shard_count)
+
+    def get(self, job_id):
+        """Timestamp of last successful run of job, None if it is unknown"""
+
+        return self._buckets.get(self.bucket(job_id), {}).get(job_id)
+
+    def record(self, job_id, timestamp):
+        bucket = self.bucket(job_id)
+        with self._lock:
+            checkpoints = self._buckets[bucket]
+            if timestamp > checkpoints.get(job_id, 0):
+                checkpoints[job_id] = timestamp
+                self._dirty.add(bucket)
+
+    def load(self, job_ids):
+        """Merge checkpoints written by previous holders of locks, dropping jobs that are not in workload"""
+
+        response = self.consul.client.get(f"/v1/kv/{self.prefix}", {"recurse": "true"})
+        if response.status_code == 404:
+            return
+        if response.status_code != 200:
+            raise Exception(f"failed to read checkpoints, status code: {response.status_code}")
+
+        job_ids = set(job_ids)
+        with self._lock:
+            for entry in response.json():
+                if not entry.get("Value"):
+                    continue
+                stored = json.loads(base64.b64decode(entry["Value"]))
+                for job_id, timestamp in stored.items():
+                    checkpoints = self._buckets[self.bucket(job_id)]
+                    checkpoints[job_id] = max(timestamp, checkpoints.get(job_id, 0))
+            for checkpoints in self._buckets.values():
+                for job_id in checkpoints.keys() - job_ids:
+                    del checkpoints[job_id]
+
+    def _lock_key(self, bucket):
+        """Key of lock instance must hold to write bucket"""
+
+        if self.consul.sharded:
+            return f"{self.consul.shards_prefix}{bucket}"
+        return self.consul.election_key
+
+    def _transactions(self, buckets):
+        """Split writes of buckets into transactions, yields operations, positions of lock checks and buckets
+
+        Every transaction checks lock of each bucket it writes once.
+        """
+
+        operations, checks, written = [], {}, set()
+        for bucket in sorted(buckets):
+            key = self._lock_key(bucket)
+            needed = 1 if key in checks else 2
+            if len(operations) + needed > TXN_MAX_OPERATIONS:
+                yield operations, checks, written
+                operations, checks, written = [], {}, set()
+            if key not in checks:
+                checks[key] = len(operations)
+                operations.append({"KV": {"Verb": "check-session", "Key": key, "Session": self.consul.session_id}})
+            with self._lock:
+                value = json.dumps(self._buckets[bucket], separators=(",", ":"))
+            operations.append(
+                {"KV": {"Verb": "set", "Key": f"{self.prefix}{bucket}", "Value": base64.b64encode(value.encode()).decode()}}
+            )
+            written.add(bucket)
+        if operations:
+            yield operations, checks, written
+
+    def flush(self):
+        """Write dirty buckets, buckets whose lock is lost are dropped, others are retried on next flush"""
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty or self.consul.session_id is None:
+            return
+
+        lost = set()
+        for operations, checks, written in self._transactions(set(dirty)):
+            try:
+                response = self.consul.client.txn(operations)
+                if response.status_code == 200:
+                    dirty -= written
+                    continue
+                if response.status_code != 409:
+                    raise Exception(f"status code: {response.status_code}")
+                failed = {error["OpIndex"] for error in response.json()["Errors"] or ()}
+                lost.update(key for key, position in checks.items() if position in failed)
+            except Exception as e:
+                logger.error(f"error writing checkpoints: {e}")
+
+        dropped = {bucket for bucket in dirty if self._lock_key(bucket) in lost}
+        if dropped:
+            logger.info(f"checkpoints of {len(dropped)} buckets not written, this instance doesn't hold their locks")
+        dirty -= dropped
+        with self._lock:
+            self._dirty |= dirty
+
+    def run_flush(self):
+        """Thread to write checkpoints of finished runs every interval"""
+
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+def catch_up(jobs, known, submit, until):
+    """Dispatch runs of jobs missed since their checkpoints and planned before timestamp until, per catch-up policy
+
+    Checkpoints of jobs not in known IDs are forgotten. Returns number of dispatched runs.
+    """
+
+    try:
+        store.load(known)
+    except Exception as e:
+        logger.error(f"error loading checkpoints, missed runs are not caught up: {e}")
+        return 0
+
+    dispatched = 0
+    for key, job in jobs.items():
+        limit = policy(job.task)
+        since = store.get(key)
+        if not limit or since is None:
+            continue
+        fire_times = missed(job.trigger, since, until, limit)
+        if fire_times:
+            last = datetime.datetime.fromtimestamp(since)
+            logger.info(f"catching up {len(fire_times)} missed runs of job {key}, last successful run was planned at {last}")
+        for fire_time in fire_times:
+            metrics.schedule.submitted(key, fire_time, catchup=True)
+            metrics.catchup_runs.inc(key)
+            submit(job, fire_time)
+            dispatched += 1
+    return dispatched
@@ -1,4 +1,5 @@
 import atexit
+import base64
 import json
 import logging
 import os
@@ -8,9 +9,72 @@ import threading
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import health
+import metrics
+from shard import HashRing, shard_of
 
 logger = logging.getLogger(__name__)
 
+# Max number of operations consul accepts in one transaction
+TXN_MAX_OPERATIONS = 64
+
+
+class ConsulClient:
+    """Client of consul HTTP API sharing one pool of keep-alive connections
+
+    Requests that failed to connect are retried, GET requests are also retried on 502-504.
+    Other failures are left to caller, as most consul writes are not idempotent.
+    """
+
+    def __init__(self, scheme, hostname, port, token=None, timeout=5, retries=3, wait=30):
+        self.base_url = f"{scheme}://{hostname}:{port}"
+        self.timeout = timeout
+        self.wait = wait
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            backoff_factor=0.1,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=retry))
+        self.session.headers["Content-Type"] = "application/json"
+        if token:
+            self.session.headers["X-Consul-Token"] = token
+
+    def get(self, path, params=None):
+        return self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+
+    def put(self, path, payload=None, params=None):
+        data = json.dumps(payload) if payload is not None else None
+        return self.session.put(self.base_url + path, data=data, params=params, timeout=self.timeout)
+
+    def txn(self, operations):
+        """Apply operations atomically, response has 'Results' on 200 and 'Errors' on 409 when rolled back"""
+
+        return self.put("/v1/txn", operations)
+
+    def blocking_query(self, path, index):
+        """Run consul blocking query, returns response and index to pass to the next query"""
+
+        # Consul adds up to wait/16 of jitter to blocking queries
+        params = {"index": index, "wait": f"{self.wait}s"}
+        response = self.session.get(self.base_url + path, params=params, timeout=self.wait * 1.1 + 5)
+        new_index = int(response.headers.get("X-Consul-Index", 0))
+        if new_index < index:
+            return response, 0  # Index went backwards, e.g. after snapshot restore
+        return response, max(new_index, 1)
+
+    def close(self):
+        self.session.close()
+
 
 class Consul:
 
@@ -31,50 +95,167 @@ class Consul:
             "host.docker.internal",
         )
         self.healthcheck_port = int(os.getenv("HEALTHCHECK_PORT", 8080))
+        self.healthcheck_mode = os.getenv("HEALTHCHECK_MODE", "http").lower()
+        self.scheduling_mode = os.getenv("SCHEDULING_MODE", "leader").lower()
+        self.shard_count = int(os.getenv("SHARD_COUNT", 64))
+        self.shard_vnodes = int(os.getenv("SHARD_VNODES", 64))
+        self.session_ttl = int(os.getenv("SESSION_TTL", 15))
+        self.session_renew_interval = float(os.getenv("SESSION_RENEW_INTERVAL", 5))
+        self.watch_wait = int(os.getenv("WATCH_WAIT", 30))
+        self.startup_timeout = float(os.getenv("STARTUP_TIMEOUT", 30))
+        self.demotion_bound = float(os.getenv("DEMOTION_BOUND", 0.1))
+        self.client = ConsulClient(
+            self.consul_scheme,
+            self.consul_hostname,
+            self.consul_port,
+            self.consul_token,
+            timeout=float(os.getenv("CONSUL_TIMEOUT", 5)),
+            retries=int(os.getenv("CONSUL_RETRIES", 3)),
+            wait=self.watch_wait,
+        )
 
-        self.is_leader = False
+        # Leadership state, exactly one of the events is set at any time
+        self.leadership_acquired = threading.Event()
+        self.leadership_lost = threading.Event()
+        self.leadership_lost.set()
+        self._leadership_listeners = []
+        self._listeners_lock = threading.RLock()  # Change of leadership and registration of listener don't interleave
+        self._release_listeners = []
+        self.sharded = self.scheduling_mode == "sharded"
+        self.owned_shards = frozenset()
+        self.shards_changed = threading.Event()
+
+        # Fencing tokens, ModifyIndex of lock key held by this instance
+        self.lock_index = None
+        self.shard_indexes = {}
+
+        # Monotonic time session may expire in consul unless renewed before, event is set on every renewal
+        self.lease_expires = 0.0
+        self.lease_renewed = threading.Event()
+
+        if self.healthcheck_mode not in ("http", "ttl"):
+            logger.error(f"unknown HEALTHCHECK_MODE '{self.healthcheck_mode}', expected 'http' or 'ttl'")
+            os._exit(1)
+        self.check_id = f"service:{self.service_id}"
+        self.health_status = health.PASSING  # Last status reported in TTL check mode
         self.start_consul()
 
-    def _get_headers(self):
-        """Function to simplify work with consul_token"""
+    @property
+    def is_leader(self):
+        return self.leadership_acquired.is_set()
+
+    def _set_leader(self, is_leader):
+        """Move leadership state machine and notify listeners on change"""
+
+        with self._listeners_lock:
+            if is_leader == self.is_leader:
+                return
+            if is_leader:
+                self.leadership_lost.clear()
+                self.leadership_acquired.set()
+            else:
+                self.leadership_acquired.clear()
+                self.leadership_lost.set()
+            metrics.leader.set(int(is_leader))
+            for callback in list(self._leadership_listeners):
+                try:
+                    callback(is_leader)
+                except Exception as e:
+                    logger.error(f"error in leadership listener: {e}")
+
+    def on_leadership_change(self, callback, since=None):
+        """Register callback(is_leader) called from election thread on every leadership change
+
+        since is leadership state caller acted on last, callback is called right away if it differs, so change
+        that happened before registration is delivered exactly once.
+        """
+
+        with self._listeners_lock:
+            self._leadership_listeners.append(callback)
+            if since is not None and self.is_leader != since:
+                callback(self.is_leader)
+
+    def off_leadership_change(self, callback):
+        with self._listeners_lock:
+            self._leadership_listeners.remove(callback)
+
+    def on_shards_release(self, callback):
+        """Register callback(shards) called from shard election thread right before locks of shards are released"""
+
+        self._release_listeners.append(callback)
+
+    def lease_valid(self):
+        """True if session can't have expired in consul yet, with margin of demotion bound"""
+
+        return time.monotonic() < self.lease_expires - self.demotion_bound
+
+    def _extend_lease(self, started):
+        """Record session renewed by request sent at monotonic time started, waking lease guard"""
+
+        self.lease_expires = started + self.session_ttl
+        self.lease_renewed.set()
 
-        headers = {"Content-Type": "application/json"}
-        if self.consul_token:
-            headers["X-Consul-Token"] = self.consul_token
-        return headers
+    def fencing_token(self, task):
+        """ModifyIndex of lock task is dispatched under, None if this instance doesn't hold it"""
+
+        if self.sharded:
+            return self.shard_indexes.get(shard_of(task["id"], self.shard_count))
+        return self.lock_index if self.is_leader else None
+
+    def wait_for_leadership(self, timeout=None):
+        """Block until this instance becomes the leader, returns False on timeout"""
+
+        return self.leadership_acquired.wait(timeout)
+
+    def backoff(self, attempt):
+        """Jittered exponential delay before retrying failed consul call"""
+
+        return min(30, 2**attempt) * random.uniform(0.5, 1)
 
     def start_consul(self):
         """Main thread of consul worker"""
 
         # Internal state machine
         self.registered = threading.Event()
+        self.session_ready = threading.Event()
         self.session_id = None
         self.election_key = f"service/{self.service_name}/leader"
+        self.shards_prefix = f"service/{self.service_name}/shards/"
 
         atexit.register(self.cleanup)
-        self.deregister_service()
 
-        # Registration
+        # Registration and session don't depend on each other, registering again with the same ID replaces
+        # previous registration, so both start at once without deregistering first
         registration_thread = threading.Thread(target=self.run_registration, daemon=True)
         registration_thread.start()
-        while not self.registered.is_set():
-            pass  # Wait until registration complete to continue
-
-        # Session
         session_thread = threading.Thread(target=self.run_session_management, daemon=True)
         session_thread.start()
-        while not self.session_id:
-            pass  # Wait until we get session to continue
+        if not self.registered.wait(self.startup_timeout):
+            logger.error(f"service registration not completed in {self.startup_timeout}s, exiting")
+            os._exit(1)
+        if not self.session_ready.wait(self.startup_timeout):
+            logger.error(f"session not created in {self.startup_timeout}s, exiting")
+            os._exit(1)
+
+        # Lease guard
+        threading.Thread(target=self.run_lease_guard, daemon=True).start()
 
         # Election
-        election_thread = threading.Thread(target=self.run_election, daemon=True)
+        if self.sharded:
+            election_thread = threading.Thread(target=self.run_shard_election, daemon=True)
+        else:
+            election_thread = threading.Thread(target=self.run_election, daemon=True)
         election_thread.start()
 
     def cleanup(self):
         """Handler of all exit code for clean shutdown"""
         logger.info("stopping consul client...")
-        self.release_lock()
+        if self.sharded:
+            self.release_shards(self.owned_shards)
+        else:
+            self.release_lock()
         self.deregister_service()
+        self.client.close()
 
     def run_registration(self):
         """Thread to run registration and periodical checks if registration is still valid"""
@@ -82,23 +263,25 @@ class Consul:
         def _register(self):
             """Register the service with Consul including the health check."""
 
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/agent/service/register"
+            if self.healthcheck_mode == "ttl":
+                # Instance reports its own health, session is bound to the check so reports also keep session alive
+                check = {"TTL": f"{self.session_ttl}s", "Status": "passing"}
+            else:
+                check = {
+                    "HTTP": f"{self.healthcheck_scheme}://{self.healthcheck_hostname}:{self.healthcheck_port}",
+                    "Interval": "5s",
+                    "Timeout": "1s",
+                }
             payload = {
                 "ID": self.service_id,
                 "Name": self.service_name,
                 "Address": self.healthcheck_hostname,
                 "Port": self.healthcheck_port,
-                "Check": {
-                    "HTTP": f"{self.healthcheck_scheme}://{self.healthcheck_hostname}:{self.healthcheck_port}",
-                    "Interval": "5s",
-                    "Timeout": "1s",
-                    "DeregisterCriticalServiceAfter": "30s",
-                },
+                "Check": dict(check, CheckID=self.check_id, DeregisterCriticalServiceAfter="30s"),
             }
-            headers = self._get_headers()
 
             try:
-                response = requests.put(url, data=json.dumps(payload), headers=headers)
+                response = self.client.put("/v1/agent/service/register", payload)
                 if response.status_code == 200:
                     logger.info(f"service '{self.service_name}' with ID '{self.service_id}' registered successfully.")
                     self.registered.set()
@@ -115,11 +298,8 @@ class Consul:
         def _check_register(self):
             """Check if the service is registered and healthy."""
 
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/catalog/service/{self.service_name}"
-            headers = self._get_headers()
-
             try:
-                response = requests.get(url, headers=headers)
+                response = self.client.get(f"/v1/catalog/service/{self.service_name}")
                 if response.status_code == 200:
                     data = response.json()
                     if not data:
@@ -148,20 +328,28 @@ class Consul:
         def _create_session(self):
             """Create consul session"""
 
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/session/create"
             payload = {
                 "Name": self.service_name,
-                "TTL": "15s",
+                "TTL": f"{self.session_ttl}s",
                 "LockDelay": "0s",
                 "Behavior": "delete",
             }
-            headers = self._get_headers()
+            if self.healthcheck_mode == "ttl":
+                # Session without own TTL lives as long as node and TTL check of service are not critical
+                del payload["TTL"]
+                payload["NodeChecks"] = ["serfHealth"]
+                payload["ServiceChecks"] = [{"ID": self.check_id}]
+                if not self.registered.wait(self.startup_timeout):
+                    return False  # Main thread exits on missing registration
 
             try:
-                response = requests.put(url, data=json.dumps(payload), headers=headers)
+                started = time.monotonic()
+                response = self.client.put("/v1/session/create", payload)
                 if response.status_code == 200:
+                    self._extend_lease(started)
                     self.session_id = response.json().get("ID")
                     logger.info(f"session created with ID: '{self.session_id}'")
+                    self.session_ready.set()
                     return True
                 else:
                     logger.error(
@@ -175,12 +363,12 @@ class Consul:
         def _renew_session(self):
             """Renews the session to maintain leadership."""
 
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/session/renew/{self.session_id}"
-            headers = self._get_headers()
-
             try:
-                response = requests.put(url, headers=headers)
+                started = time.monotonic()
+                response = self.client.put(f"/v1/session/renew/{self.session_id}")
+                metrics.session_renew_duration.observe(time.monotonic() - started)
                 if response.status_code == 200:
+                    self._extend_lease(started)
                     logger.debug(f"session {self.session_id} renewed.")
                     return True
                 else:
@@ -192,92 +380,304 @@ class Consul:
                 logger.error(f"error renewing session: {e}")
                 os._exit(1)
 
+        def _report_health(self):
+            """Push health status to TTL check, which also renews session bound to it"""
+
+            started = time.monotonic()
+            lapsed = started > self.lease_expires
+            status, output = health.status(renewal_late=started > self.lease_expires - self.session_ttl / 2)
+            try:
+                response = self.client.put(f"/v1/agent/check/update/{self.check_id}", {"Status": status, "Output": output})
+                metrics.session_renew_duration.observe(time.monotonic() - started)
+                if response.status_code != 200:
+                    logger.error(
+                        f"failed to update health check, status code: {response.status_code}, message: {str(response.content)}"
+                    )
+                    os._exit(1)
+                if status == health.CRITICAL:
+                    logger.error(f"health check is failing, session is invalidated, exiting: {output}")
+                    os._exit(1)
+                if lapsed and not _session_exists(self):
+                    logger.error(f"check was not updated within its TTL, session {self.session_id} was invalidated, exiting")
+                    os._exit(1)
+                self._extend_lease(started)
+                if status != self.health_status:
+                    log = logger.info if status == health.PASSING else logger.warning
+                    log(f"health check is {status}: {output}")
+                    self.health_status = status
+                logger.debug(f"health check updated to {status}: {output}")
+            except Exception as e:
+                logger.error(f"error updating health check: {e}")
+                os._exit(1)
+
+        def _session_exists(self):
+            response = self.client.get(f"/v1/session/info/{self.session_id}")
+            return response.status_code == 200 and bool(response.json())
+
         if _create_session(self):
+            renew = _report_health if self.healthcheck_mode == "ttl" else _renew_session
             while True:
-                time.sleep(5)
-                _renew_session(self)
+                time.sleep(self.session_renew_interval)
+                renew(self)
 
     def run_election(self):
-        """Thread to run consul election"""
+        """Thread to run consul election, watching lock key with blocking queries"""
 
         def _acquire_lock(self):
-            """Acquire lock with current session ID to became leader"""
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/kv/{self.election_key}?acquire={self.session_id}"
-            headers = self._get_headers()
-            payload = {"leader": self.session_id}
+            """Acquire lock with current session ID and read it back in one transaction, returns its ModifyIndex"""
+
+            value = base64.b64encode(json.dumps({"leader": self.session_id}).encode()).decode()
+            operations = [
+                {"KV": {"Verb": "lock", "Key": self.election_key, "Value": value, "Session": self.session_id}},
+                {"KV": {"Verb": "get", "Key": self.election_key}},
+            ]
 
             try:
-                response = requests.put(url, headers=headers, data=json.dumps(payload))
-                if response.status_code == 200 and response.json():
-                    logger.info("lock acquired, this instance is now the leader.")
-                    self.is_leader = True
-                    return True
-                else:
+                response = self.client.txn(operations)
+                if response.status_code == 200:
+                    return response.json()["Results"][1]["KV"]["ModifyIndex"]
+                elif response.status_code == 409:
                     logger.debug("failed to acquire lock, another instance may be the leader.")
-                    return False
+                else:
+                    logger.error(f"failed to acquire lock, status code: {response.status_code}")
             except Exception as e:
                 logger.error(f"error acquiring lock: {e}")
-                os.exit(1)
+            return None
+
+        def _watch_lock(self, index):
+            """Block until lock key changes after index, returns new index, session holding the lock and its ModifyIndex"""
+
+            response, index = self.client.blocking_query(f"/v1/kv/{self.election_key}", index)
+            if response.status_code == 404:
+                return index, None, None
+            elif response.status_code == 200:
+                data = response.json()
+                if not data:
+                    return index, None, None
+                return index, data[0].get("Session"), data[0].get("ModifyIndex")
+            else:
+                raise Exception(f"status code: {response.status_code}")
 
-        def _update_lock(self):
-            """Update modify index of lock to indicate that leader is alive"""
+        index = 0
+        attempt = 0
+        while True:
+            try:
+                started = time.monotonic()
+                index, holder, modify_index = _watch_lock(self, index)
+                metrics.lock_watch_duration.observe(time.monotonic() - started)
+                attempt = 0
+            except Exception as e:
+                attempt += 1
+                logger.error(f"error watching lock: {e}")
+                time.sleep(self.backoff(attempt))
+                continue
+
+            if holder is None:
+                if self.is_leader:
+                    logger.warning("lock was released, this instance is no longer the leader.")
+                    self._set_leader(False)
+                logger.info("lock is free, trying to get leadership")
+                modify_index = _acquire_lock(self)
+                if modify_index is not None and self.lease_valid():
+                    self.lock_index = modify_index
+                    logger.info(f"lock acquired, this instance is now the leader, fencing token {modify_index}.")
+                    self._set_leader(True)
+            elif holder == self.session_id:
+                if not self.is_leader and self.lease_valid():
+                    self.lock_index = modify_index
+                    logger.info(f"lock is held by this session, this instance is now the leader, fencing token {modify_index}.")
+                    self._set_leader(True)
+                logger.debug("still the leader.")
+            else:
+                if self.is_leader:
+                    logger.warning("lock is held by another session, this instance is no longer the leader.")
+                    self._set_leader(False)
+                logger.debug("not a leader")
 
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/kv/{self.election_key}?index={self._lock_modify_index}"
-            headers = self._get_headers()
+    def run_shard_election(self):
+        """Thread to split jobs between all instances that are not critical, holding one lock per owned shard"""
+
+        def _live_instances(self):
+            """IDs of service instances without critical health checks
+
+            Instances in warning stay on hash ring, lag of downstream shared by all of them must not empty it.
+            """
 
             try:
-                response = requests.get(url, headers=headers)
-                if response.status_code == 200 and response.json():
-                    data = response.json()
-                    self._lock_modify_index = data[0].get("ModifyIndex")
-                    logger.debug(f"lock updated, new index is {self._lock_modify_index}")
+                response = self.client.get(f"/v1/health/service/{self.service_name}")
+                if response.status_code == 200:
+                    return [
+                        entry["Service"]["ID"]
+                        for entry in response.json()
+                        if all(check.get("Status") != "critical" for check in entry.get("Checks", []))
+                    ]
                 else:
-                    logger.error(f"failed to update lock, status code: {response.status_code}")
+                    logger.error(f"failed to list live instances, status code: {response.status_code}")
             except Exception as e:
-                logger.error(f"error updating lock: {e}")
+                logger.error(f"error listing live instances: {e}")
+            return None
 
-        def _watch_lock(self):
-            """Watch the lock key for changes to respond to leader election."""
-            url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/kv/{self.election_key}?wait=5s"
-            headers = self._get_headers()
+        def _shard_holders(self):
+            """Map of shard number to session holding its lock and ModifyIndex of lock key"""
 
             try:
-                response = requests.get(url, headers=headers)
+                response = self.client.get(f"/v1/kv/{self.shards_prefix}", {"recurse": "true"})
                 if response.status_code == 404:
-                    _acquire_lock(self)
+                    return {}
                 elif response.status_code == 200:
-                    data = response.json()
-                    if data and data[0].get("Session") == self.session_id:
-                        _update_lock(self)
-                        logger.debug("still the leader.")
-                    else:
-                        if data[0].get("ModifyIndex") == self._lock_modify_index:
-                            logger.info(f"'ModifyIndex' is not updating, trying to get leadership")
-                            _acquire_lock(self)
-                        else:
-                            self._lock_modify_index = data[0].get("ModifyIndex")
-                            logger.debug("not a leader")
+                    return {
+                        int(entry["Key"][len(self.shards_prefix) :]): (entry.get("Session"), entry.get("ModifyIndex"))
+                        for entry in response.json()
+                        if entry["Key"][len(self.shards_prefix) :].isdigit() and entry.get("Session")
+                    }
                 else:
-                    logger.error(f"failed to watch lock, status code: {response.status_code}")
+                    logger.error(f"failed to read shard locks, status code: {response.status_code}")
             except Exception as e:
-                logger.error(f"error watching lock: {e}")
+                logger.error(f"error reading shard locks: {e}")
+            return None
+
+        def _lock_operations(self, shards):
+            """Operations locking shards with current session ID, each lock is read back by get right after it"""
+
+            value = base64.b64encode(json.dumps({"owner": self.service_id}).encode()).decode()
+            operations = []
+            for shard in shards:
+                key = f"{self.shards_prefix}{shard}"
+                operations.append({"KV": {"Verb": "lock", "Key": key, "Value": value, "Session": self.session_id}})
+                operations.append({"KV": {"Verb": "get", "Key": key}})
+            return operations
+
+        def _acquire_shard(self, shard):
+            """Acquire lock of shard with current session ID, returns its ModifyIndex or None"""
+
+            try:
+                response = self.client.txn(_lock_operations(self, [shard]))
+                if response.status_code == 200:
+                    logger.debug(f"lock of shard {shard} acquired")
+                    return response.json()["Results"][1]["KV"]["ModifyIndex"]
+                else:
+                    logger.debug(f"failed to acquire lock of shard {shard}")
+            except Exception as e:
+                logger.error(f"error acquiring lock of shard {shard}: {e}")
+            return None
+
+        def _acquire_shards(self, shards):
+            """Acquire locks of shards in transactions, falling back to one by one when a transaction is rolled back
+
+            Returns ModifyIndex of every acquired lock by shard.
+            """
+
+            acquired = {}
+            shards = sorted(shards)
+            size = TXN_MAX_OPERATIONS // 2  # Lock and get of every shard
+            for start in range(0, len(shards), size):
+                chunk = shards[start : start + size]
+                try:
+                    response = self.client.txn(_lock_operations(self, chunk))
+                    if response.status_code == 200:
+                        results = response.json()["Results"]
+                        acquired.update((shard, results[2 * i + 1]["KV"]["ModifyIndex"]) for i, shard in enumerate(chunk))
+                        continue
+                    logger.debug(f"transaction acquiring {len(chunk)} shards rolled back, status code: {response.status_code}")
+                except Exception as e:
+                    logger.error(f"error acquiring shards: {e}")
+                for shard in chunk:
+                    index = _acquire_shard(self, shard)
+                    if index is not None:
+                        acquired[shard] = index
+            return acquired
+
+        def _rebalance(self):
+            """Acquire shards assigned to this instance by hash ring and release all others"""
+
+            if not self.lease_valid():
+                return  # Lease guard dropped all shards, wait for session renewal
+            instances = _live_instances(self)
+            holders = _shard_holders(self)
+            if instances is None or holders is None:
+                return
+
+            ring = HashRing(instances, self.shard_vnodes)
+            desired = {shard for shard in range(self.shard_count) if ring.owner(shard) == self.service_id}
+            held = {shard for shard, (session, _) in holders.items() if session == self.session_id}
+
+            # Fencing tokens of shards to be released are dropped first, so their runs are no longer sent
+            kept = {shard: holders[shard][1] for shard in held & desired}
+            self.shard_indexes = kept
+            self.shard_indexes = {**kept, **_acquire_shards(self, desired - held - holders.keys())}
+            owned = set(self.shard_indexes)
+
+            if owned != self.owned_shards:
+                logger.info(f"owning {len(owned)} of {self.shard_count} shards across {len(instances)} instances")
+                self.owned_shards = frozenset(owned)
+                metrics.owned_shards.set(len(owned))
+                self.shards_changed.set()
+
+            # Release only after scheduler was told to drop jobs of released shards
+            released = held - desired
+            if released:
+                for callback in self._release_listeners:
+                    try:
+                        callback(released)
+                    except Exception as e:
+                        logger.error(f"error in shards release listener: {e}")
+            self.release_shards(released)
+
+        def _watch(self, path, changed):
+            """Set changed event every time blocking query on path returns new index"""
+
+            index = 0
+            attempt = 0
+            while True:
+                try:
+                    response, new_index = self.client.blocking_query(path, index)
+                    if response.status_code not in (200, 404):
+                        raise Exception(f"status code: {response.status_code}")
+                    attempt = 0
+                except Exception as e:
+                    attempt += 1
+                    logger.error(f"error watching {path}: {e}")
+                    time.sleep(self.backoff(attempt))
+                    continue
+
+                if new_index != index:
+                    index = new_index
+                    changed.set()
+
+        changed = threading.Event()
+        for path in (f"/v1/health/service/{self.service_name}", f"/v1/kv/{self.shards_prefix}?recurse=true"):
+            threading.Thread(target=_watch, args=(self, path, changed), daemon=True).start()
 
-        self._lock_modify_index = int()
         while True:
+            changed.wait(timeout=self.watch_wait)
+            changed.clear()
+            _rebalance(self)
+
+    def run_lease_guard(self):
+        """Thread to stop dispatching before session may expire in consul, e.g. when renewals hang during partition"""
+
+        while True:
+            self.lease_renewed.clear()
+            remaining = self.lease_expires - self.demotion_bound - time.monotonic()
+            if remaining > 0:
+                self.lease_renewed.wait(remaining)  # Sleeps until lease is about to run out, renewal recomputes it
+                continue
             if self.is_leader:
-                time.sleep(5)
-            else:
-                time.sleep(10)
-            _watch_lock(self)
+                logger.warning("session was not renewed in time, this instance is no longer the leader.")
+                self._set_leader(False)
+            if self.owned_shards:
+                logger.warning("session was not renewed in time, dropping all shards.")
+                self.owned_shards = frozenset()
+                self.shard_indexes = {}
+                metrics.owned_shards.set(0)
+                self.shards_changed.set()
+            self.lease_renewed.wait()  # Nothing to guard until session is renewed
 
     def deregister_service(self):
         """Deregister service with Consul"""
 
-        url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/agent/service/deregister/{self.service_id}"
-        headers = self._get_headers()
-
         try:
-            response = requests.put(url, headers=headers)
+            response = self.client.put(f"/v1/agent/service/deregister/{self.service_id}")
             if response.status_code == 200:
                 logger.info(f"service with ID '{self.service_id}' deregistered successfully.")
                 self.registered.clear()
@@ -300,12 +700,10 @@ class Consul:
             logger.error("no session created, cannot release lock.")
             return
 
-        url = f"{self.consul_scheme}://{self.consul_hostname}:{self.consul_port}/v1/kv/{self.election_key}?release={self.session_id}"
-        headers = self._get_headers()
-        payload = {"leader": self.session_id}
-
         try:
-            response = requests.put(url, headers=headers, data=json.dumps(payload))
+            response = self.client.put(
+                f"/v1/kv/{self.election_key}", {"leader": self.session_id}, {"release": self.session_id}
+            )
             if response.status_code == 200:
                 if response.content == b"true":
                     logger.info("lock released successfully.")
@@ -317,3 +715,37 @@ class Consul:
         except Exception as e:
             logger.error(f"error releasing lock: {e}")
             os._exit(1)
+
+    def release_shards(self, shards):
+        """Releases locks of shards held by this instance in transactions."""
+
+        shards = sorted(shards)
+        for start in range(0, len(shards), TXN_MAX_OPERATIONS):
+            chunk = shards[start : start + TXN_MAX_OPERATIONS]
+            operations = [
+                {"KV": {"Verb": "unlock", "Key": f"{self.shards_prefix}{shard}", "Session": self.session_id}}
+                for shard in chunk
+            ]
+            try:
+                response = self.client.txn(operations)
+                if response.status_code == 200:
+                    logger.debug(f"locks of {len(chunk)} shards released")
+                    continue
+                # Unlock of shard not held anymore rolls back whole transaction
+                logger.debug(f"transaction releasing {len(chunk)} shards rolled back, status code: {response.status_code}")
+            except Exception as e:
+                logger.error(f"error releasing locks of shards: {e}")
+            for shard in chunk:
+                self.release_shard(shard)
+
+    def release_shard(self, shard):
+        """Releases lock of shard if this instance holds it."""
+
+        try:
+            response = self.client.put(f"/v1/kv/{self.shards_prefix}{shard}", params={"release": self.session_id})
+            if response.status_code == 200:
+                logger.debug(f"lock of shard {shard} released")
+            else:
+                logger.error(f"failed to release lock of shard {shard}. Status code: {response.status_code}")
+        except Exception as e:
+            logger.error(f"error releasing lock of shard {shard}: {e}")
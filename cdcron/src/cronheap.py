@@ -0,0 +1,257 @@
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from workload import OffsetTrigger
+
+logger = logging.getLogger(__name__)
+
+# Field name, min value, max value, names allowed in expressions (APScheduler conventions, 0 is Monday)
+FIELDS = (
+    ("minute", 0, 59, {}),
+    ("hour", 0, 23, {}),
+    ("day", 1, 31, {}),
+    ("month", 1, 12, {n: i + 1 for i, n in enumerate("jan feb mar apr may jun jul aug sep oct nov dec".split())}),
+    ("day_of_week", 0, 6, {n: i for i, n in enumerate("mon tue wed thu fri sat sun".split())}),
+)
+
+
+def _parse_field(expr, low, high, names):
+    """Parse one crontab field into bitmask, bit N is set when value N matches"""
+
+    mask = 0
+    for part in expr.lower().split(","):
+        value_range, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if value_range == "*":
+            start, end = low, high
+        elif "-" in value_range:
+            start, end = (int(names.get(v, v)) for v in value_range.split("-", 1))
+        else:
+            start = int(names.get(value_range, value_range))
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f"unsupported value '{part}', expected {low}-{high}")
+        for value in range(start, end + 1, step):
+            mask |= 1 << value
+    return mask
+
+
+class CronMask:
+    """Crontab compiled into one bitmask per field"""
+
+    def __init__(self, minute, hour, day, month, day_of_week):
+        self.minute = _parse_field(minute, *FIELDS[0][1:])
+        self.hour = _parse_field(hour, *FIELDS[1][1:])
+        self.day = _parse_field(day, *FIELDS[2][1:])
+        self.month = _parse_field(month, *FIELDS[3][1:])
+        self.day_of_week = _parse_field(day_of_week, *FIELDS[4][1:])
+
+    @classmethod
+    def from_trigger(cls, trigger):
+        """Compile APScheduler CronTrigger created from crontab"""
+
+        fields = {field.name: str(field) for field in trigger.fields}
+        if fields["second"] != "0" or fields["year"] != "*" or fields["week"] != "*":
+            raise ValueError(f"only crontab fields are supported: {trigger}")
+        return cls(*(fields[name] for name, *_ in FIELDS))
+
+    def next_fire_time(self, after):
+        """First local naive datetime strictly after 'after' that matches, None if none in 5 years"""
+
+        moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=5 * 366)
+        while moment < limit:
+            if not self.month >> moment.month & 1:
+                month = moment.month % 12 + 1
+                moment = moment.replace(year=moment.year + (month == 1), month=month, day=1, hour=0, minute=0)
+            elif not (self.day >> moment.day & 1 and self.day_of_week >> moment.weekday() & 1):
+                moment = (moment + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+            elif not self.hour >> moment.hour & 1:
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+            else:
+                later = self.minute >> moment.minute
+                if later:
+                    # Index of lowest set bit is the offset to next matching minute
+                    return moment.replace(minute=moment.minute + (later & -later).bit_length() - 1)
+                moment = (moment + datetime.timedelta(hours=1)).replace(minute=0)
+        return None
+
+
+class TriggerSchedule:
+    """Schedule CronMask can't compile, like 'last' day of month, fire times are computed by its trigger"""
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+
+    def next_fire_time(self, after):
+        """First local naive datetime strictly after 'after' when trigger fires, None if it never fires again"""
+
+        now = after.astimezone(self.trigger.timezone) + datetime.timedelta(microseconds=1)
+        moment = self.trigger.get_next_fire_time(None, now)
+        return moment.astimezone().replace(tzinfo=None) if moment else None
+
+
+def compile_schedule(trigger):
+    """Compile trigger into bitmasks, falling back to trigger itself for expressions bitmasks don't support"""
+
+    try:
+        return CronMask.from_trigger(trigger)
+    except ValueError as e:
+        logger.info(f"schedule '{trigger}' is computed by its trigger, not compiled: {e}")
+        return TriggerSchedule(trigger)
+
+
+class Group:
+    """Jobs sharing one schedule and smear offset, fired together as one batch"""
+
+    def __init__(self, mask, offset=0.0):
+        self.mask = mask  # CronMask or TriggerSchedule
+        self.offset = offset  # Seconds every fire time of mask is shifted by
+        self.jobs = {}
+        self.next_fire = None
+        self.removed = False
+
+
+class HeapScheduler:
+    """Scheduler core keeping next fire time of every distinct schedule in a heap
+
+    Jobs with identical crontab and smear offset share one heap entry, so cost of a tick depends on number of
+    distinct schedules, not number of jobs. Mimics the part of APScheduler API used by cdcron, job functions
+    get fire time of run as 'planned' like with HandoverExecutor.
+    """
+
+    def __init__(self, max_workers=10, misfire_grace_time=1):
+        self.misfire_grace_time = misfire_grace_time
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cronheap")
+        self._masks = {}
+        self._groups = {}
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._paused = False
+
+    def _push(self, group, after):
+        """Compute next fire time of group after timestamp and push it on heap"""
+
+        moment = group.mask.next_fire_time(datetime.datetime.fromtimestamp(after - group.offset))
+        group.next_fire = time.mktime(moment.timetuple()) + group.offset if moment else None
+        if group.next_fire is not None:
+            heapq.heappush(self._heap, (group.next_fire, next(self._sequence), group))
+
+    def add_job(self, func, trigger, args=(), id=None):
+        key = str(trigger)
+        with self._condition:
+            if id in self._jobs:
+                self._remove(id)
+            group = self._groups.get(key)
+            if group is None:
+                offset = 0.0
+                if isinstance(trigger, OffsetTrigger):
+                    trigger, offset = trigger.trigger, trigger.offset
+                cron = str(trigger)
+                if cron not in self._masks:
+                    self._masks[cron] = compile_schedule(trigger)
+                group = self._groups[key] = Group(self._masks[cron], offset)
+                self._push(group, time.time())
+                self._condition.notify()
+            group.jobs[id] = (func, tuple(args))
+            self._jobs[id] = key
+
+    def _remove(self, id):
+        key = self._jobs.pop(id)
+        group = self._groups[key]
+        del group.jobs[id]
+        if not group.jobs:
+            group.removed = True  # Heap entry is dropped lazily when it comes due
+            del self._groups[key]
+
+    def remove_job(self, id):
+        with self._condition:
+            self._remove(id)
+
+    def modify_job(self, id, func=None, args=None):
+        with self._condition:
+            group = self._groups[self._jobs[id]]
+            current_func, current_args = group.jobs[id]
+            group.jobs[id] = (func or current_func, tuple(args) if args is not None else current_args)
+
+    def reschedule_job(self, id, trigger):
+        with self._condition:
+            func, args = self._groups[self._jobs[id]].jobs[id]
+        self.add_job(func, trigger, args, id)
+
+    def start(self, paused=False):
+        self._paused = paused
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def pause(self):
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        """Resume firing, schedules that came due while paused longer than grace time ago are skipped silently"""
+
+        with self._condition:
+            self._paused = False
+            horizon = time.time() - self.misfire_grace_time
+            for group in self._groups.values():
+                if group.next_fire is not None and group.next_fire < horizon:
+                    self._push(group, horizon)
+            self._condition.notify()
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+        self.executor.shutdown(wait=wait)
+
+    def run(self):
+        """Thread to sleep until next schedule is due and hand its jobs to executor"""
+
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    delay = self._heap[0][0] - time.time() if self._heap and not self._paused else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+                fire_time, _, group = heapq.heappop(self._heap)
+                if group.removed or group.next_fire != fire_time:
+                    continue  # Stale entry of removed group
+                batch = list(group.jobs.items())
+                self._push(group, fire_time)
+            self._dispatch(batch, fire_time)
+
+    def _dispatch(self, batch, fire_time):
+        """Submit all jobs of one due schedule to executor"""
+
+        late = time.time() - fire_time
+        planned = datetime.datetime.fromtimestamp(fire_time, datetime.timezone.utc)
+        for id, (func, args) in batch:
+            if self._stopped:
+                return
+            if late > self.misfire_grace_time:
+                metrics.misfires.inc(id, "missed")
+                continue
+            metrics.schedule.submitted(id, planned)
+            self.executor.submit(self._run, id, func, args, planned)
+
+    def _run(self, id, func, args, planned):
+        try:
+            func(*args, planned=planned)
+        except Exception as e:
+            logger.error(f"job {id} failed: {e}")
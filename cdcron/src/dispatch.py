@@ -0,0 +1,414 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, HTTPError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+import joblog
+import metrics
+import tracing
+from breaker import Breakers, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Methods that send task["data"] as JSON body
+BODY_METHODS = ("PUT", "POST", "PATCH")
+
+# Errors of connection to target or of its response, others come from job definition or this instance
+TRANSPORT_ERRORS = (requests.RequestException, HTTPError, OSError)
+
+# Default number of response body bytes kept for logging
+MAX_BODY_BYTES = int(os.getenv("HTTP_MAX_BODY_BYTES", 1024))
+
+# Unread rest of response body up to this many bytes is read and dropped, so its connection is reused
+DRAIN_MAX_BYTES = int(os.getenv("HTTP_DRAIN_MAX_BYTES", 65536))
+
+# Default number of retries of failed job, base and cap of backoff between retries in seconds
+RETRIES = int(os.getenv("RETRY_COUNT", 0))
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 1))
+RETRY_MAX_BACKOFF = float(os.getenv("RETRY_MAX_BACKOFF", 60))
+
+# Header carrying fencing token of lock jobs are dispatched under, empty disables it
+FENCING_HEADER = os.getenv("FENCING_HEADER", "X-Cdcron-Fencing-Token")
+
+# Callable(task) returning fencing token of task or None, set when scheduling under consul locks
+fencing_token = None
+
+# Open connections of all pools, so requests in flight can be aborted
+_connections = weakref.WeakSet()
+_connections_lock = threading.Lock()
+
+
+class RequestCancelled(Exception):
+    """Request in flight was aborted because this instance stopped dispatching"""
+
+
+class TrackedConnection:
+    """Mixin remembering connection once it is open and timing how it was opened in trace of job run"""
+
+    def _new_conn(self):
+        """Resolve host and connect to its addresses in turn, like urllib3 does, timing both steps"""
+
+        trace = tracing.current()
+        if trace is None:
+            return super()._new_conn()
+        host = self._dns_host
+        started = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            addresses = []  # urllib3 resolves again and raises its own error
+        resolved = time.monotonic()
+        trace.add("dns", resolved - started)
+        try:
+            if not addresses:
+                return super()._new_conn()
+            for i, (*_, address) in enumerate(addresses):
+                self._dns_host = address[0]
+                try:
+                    return super()._new_conn()
+                except (ConnectTimeoutError, NewConnectionError):
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+            trace.add("connect", time.monotonic() - resolved)
+
+    def connect(self):
+        trace = tracing.current()
+        opened = trace.connecting() if trace else 0.0
+        started = time.monotonic()
+        super().connect()
+        if trace is not None and isinstance(self, HTTPSConnection):
+            trace.add("tls", time.monotonic() - started - (trace.connecting() - opened))
+        with _connections_lock:
+            _connections.add(self)
+
+
+class TrackedHTTPConnection(TrackedConnection, HTTPConnection):
+    pass
+
+
+class TrackedHTTPSConnection(TrackedConnection, HTTPSConnection):
+    pass
+
+
+class TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TrackedHTTPConnection
+
+
+class TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TrackedHTTPSConnection
+
+
+class TrackingAdapter(HTTPAdapter):
+    """Adapter creating pools of tracked connections"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TrackedHTTPConnectionPool, "https": TrackedHTTPSConnectionPool}
+
+
+def origin(url):
+    """Scheme and host of url, connection pools are kept per origin"""
+
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class SessionPool:
+    """Shared keep-alive sessions, one connection pool per target host"""
+
+    def __init__(self):
+        # Read env variables
+        self.pool_size = int(os.getenv("HTTP_POOL_SIZE", 10))
+        self.keepalive = os.getenv("HTTP_KEEPALIVE", "true").lower() == "true"
+        self.connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+        self.read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+
+        self.generation = 0  # Incremented every time requests in flight are aborted
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        """Create session with connection pool sized for one host"""
+
+        session = requests.Session()
+        adapter = TrackingAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not self.keepalive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def get(self, url):
+        """Return session for target host of url"""
+
+        key = origin(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[key] = session
+                    logger.debug(f"created connection pool for {key}")
+        return session
+
+    def warm(self, urls):
+        """Open one connection to every target host without sending a request, so first requests skip handshakes"""
+
+        if not self.keepalive:
+            return
+        for key in {origin(url) for url in urls}:
+            try:
+                pool = self.get(key).get_adapter(key).poolmanager.connection_from_url(key)
+                conn = pool._get_conn()
+                try:
+                    if not conn.is_connected:
+                        conn.timeout = self.connect_timeout
+                        conn.connect()
+                finally:
+                    pool._put_conn(conn)
+            except Exception as e:
+                logger.debug(f"failed to warm connection pool for {key}: {e}")
+
+    def abort(self):
+        """Abort requests in flight by shutting down sockets of all open connections"""
+
+        self.generation += 1
+        with _connections_lock:
+            connections = list(_connections)
+        for conn in connections:
+            sock = conn.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # Already closed
+
+    def timeout(self, task):
+        """Connect and read timeout of task, falling back to defaults"""
+
+        return (
+            float(task.get("connect_timeout", self.connect_timeout)),
+            float(task.get("read_timeout", self.read_timeout)),
+        )
+
+    def close(self):
+        """Close all sessions and their pooled connections"""
+
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+sessions = SessionPool()
+breakers = Breakers()
+
+
+def body_limit(task):
+    """Number of response body bytes to read for task, 0 if body is discarded"""
+
+    if task.get("discard_body", False):
+        return 0
+    return int(task.get("max_body_bytes", MAX_BODY_BYTES))
+
+
+def drainable(remaining):
+    """True if unread rest of body is small enough to read for reuse of connection, remaining is None if unknown"""
+
+    return sessions.keepalive and remaining is not None and remaining <= DRAIN_MAX_BYTES
+
+
+def _release(raw):
+    """Read small unread rest of body, so connection goes back to pool instead of being closed with response"""
+
+    if raw.length_remaining and drainable(raw.length_remaining):
+        raw.drain_conn()
+        raw.release_conn()
+
+
+def headers(task, token=None):
+    """Headers of task request, with fencing token of lock it is dispatched under, looked up unless given"""
+
+    if token is None and fencing_token:
+        token = fencing_token(task)
+    if token is None or not FENCING_HEADER:
+        return task.get("headers", {})
+    return dict(task.get("headers", {}), **{FENCING_HEADER: str(token)})
+
+
+def fence(task):
+    """Fencing token of lock task is dispatched under, raises RequestCancelled if this instance doesn't hold it
+
+    Checked right before request is sent, so queued, deferred and retried runs of jobs whose lock was
+    released are dropped.
+    """
+
+    if fencing_token is None:
+        return None
+    token = fencing_token(task)
+    if token is None:
+        raise RequestCancelled(f"lock of job is not held by this instance, {task['url']} not requested")
+    return token
+
+
+def failed(status_code):
+    """True if request failed and is worth retrying, status_code is None when there was no response"""
+
+    return status_code is None or status_code >= 500 or status_code == 429
+
+
+def retry_delay(task, attempt):
+    """Jittered exponential backoff before retry number attempt of task, None if no retries are left"""
+
+    if attempt > int(task.get("retries", RETRIES)):
+        return None
+    backoff = min(RETRY_MAX_BACKOFF, float(task.get("retry_backoff", RETRY_BACKOFF)) * 2 ** (attempt - 1))
+    return backoff * random.uniform(0.5, 1)
+
+
+def allow(task):
+    """Fail fast with CircuitOpenError if circuit of target host is open, returns breaker to record result in"""
+
+    breaker = breakers.get(task["url"])
+    if breaker is not None and not breaker.allow():
+        metrics.job_executions.inc(task.get("id", task["url"]), "circuit_open")
+        raise CircuitOpenError(f"circuit of {breaker.host} is open, {task['url']} not requested")
+    return breaker
+
+
+def log_response(method, task, status_code, body, limit):
+    """Log status line and at most limit bytes of body, body is read with one extra byte to detect truncation
+
+    Failed runs are always logged, successful ones per sampling of job. Message is formatted by log
+    listener thread, so arguments are passed as they are.
+    """
+
+    with tracing.phase("log"):
+        try:
+            _log_response(method, task, status_code, body, limit)
+        except Exception as e:
+            # Request was delivered already, failing to log it must not make it retried
+            logger.error(f"failed to log response of {method} request to {task['url']}: {e}")
+
+
+def _log_response(method, task, status_code, body, limit):
+    failed = 400 <= status_code < 600
+    if not failed and not (logger.isEnabledFor(logging.INFO) and joblog.sampled(task)):
+        return
+    truncated = len(body) > limit
+    if truncated:
+        body = body[:limit]
+    logger.log(
+        logging.WARNING if failed else logging.INFO,
+        "%s %s - Status Code: %s - Response: %s%s",
+        method,
+        task["url"],
+        status_code,
+        body,
+        " (truncated)" if truncated else "",
+        extra={
+            "job": task.get("id"),
+            "method": method,
+            "url": task["url"],
+            "status": status_code,
+            "response": body,
+            "truncated": truncated or None,
+        },
+    )
+
+
+def record(method, task, status_code, seconds, breaker=None):
+    """Update execution and latency metrics and circuit of task, status_code is None when request failed"""
+
+    if breaker is not None:
+        breaker.record(not failed(status_code))
+    metrics.job_executions.inc(task.get("id", task["url"]), metrics.status_class(status_code))
+    metrics.request_duration.observe(seconds, method, urlsplit(task["url"]).netloc)
+
+
+def blamed(breaker, transport):
+    """Breaker to record failed request in, None when request failed for reason unrelated to target
+
+    Errors of job definition or of this instance tell nothing about target, they only give back probe slot.
+    """
+
+    if breaker is not None and not transport:
+        breaker.release()
+        return None
+    return breaker
+
+
+def cancelled(task, breaker=None):
+    """Count request aborted in flight, cancelled request tells nothing about target, so circuit is left as it is"""
+
+    if breaker is not None:
+        breaker.release()
+    metrics.job_executions.inc(task.get("id", task["url"]), "cancelled")
+
+
+def send(method, task, token=None):
+    """Send HTTP request described by task through shared connection pools, returns status code and body
+
+    Response is streamed and only first bytes of body are read, rest of body is downloaded only when it is
+    small enough to keep connection. Raises RequestCancelled if request was aborted.
+    """
+
+    kwargs = {
+        "headers": headers(task, token),
+        "timeout": sessions.timeout(task),
+        "stream": True,
+    }
+    if method in BODY_METHODS:
+        kwargs["json"] = task.get("data", {})
+
+    limit = body_limit(task)
+    generation = sessions.generation
+    trace = tracing.current() or tracing.Trace(task)
+    try:
+        trace.sending()
+        with sessions.get(task["url"]).request(method, task["url"], **kwargs) as response:
+            trace.received()
+            body = response.raw.read(limit + 1, decode_content=True) if limit else b""
+            _release(response.raw)
+            trace.read()
+    except Exception as e:
+        if sessions.generation != generation:
+            raise RequestCancelled(f"{method} {task['url']} aborted") from e
+        raise
+    return response.status_code, body
+
+
+def request(method, task):
+    """Execute HTTP request described by task, recording its result, returns status code"""
+
+    token = fence(task)
+    breaker = allow(task)
+    started = time.monotonic()
+    metrics.in_flight.started()
+    try:
+        status_code, body = send(method, task, token)
+    except RequestCancelled:
+        cancelled(task, breaker)
+        raise
+    except Exception as e:
+        record(method, task, None, time.monotonic() - started, blamed(breaker, isinstance(e, TRANSPORT_ERRORS)))
+        raise
+    finally:
+        metrics.in_flight.finished()
+    record(method, task, status_code, time.monotonic() - started, breaker)
+    log_response(method, task, status_code, body, body_limit(task))
+    return status_code
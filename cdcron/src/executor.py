@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import checkpoint
+import dispatch
+import limits
+import metrics
+import tracing
+from breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+class Pending:
+    """Job run waiting in executor for its limits"""
+
+    __slots__ = ("func", "task", "limits", "reserved", "attempt", "generation", "planned", "submitted")
+
+    def __init__(self, func, task, limits, generation, attempt=0, planned=None):
+        self.func = func
+        self.task = task
+        self.limits = limits
+        self.reserved = False  # Rate limit tokens were already taken
+        self.attempt = attempt  # Number of retries before this run
+        self.generation = generation  # Run is dropped if executor was paused since it was submitted
+        self.planned = planned  # Fire time run was planned for, None if unknown
+        self.submitted = time.monotonic()  # Start of queue phase of run
+
+
+class JobExecutor:
+    """Runs jobs on worker pool, enforcing limits of target hosts and job groups
+
+    Job over concurrency limit is parked on that limit and admitted again when a slot is released,
+    job over rate limit is admitted by timer thread once its token is due. Failed job is retried
+    by timer thread after backoff. Waiting never holds a worker, so slow target uses only its own
+    slots and can't starve other jobs.
+    """
+
+    def __init__(self):
+        # Read env variables
+        self.workers = int(os.getenv("EXECUTOR_WORKERS", 10))
+
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        self.limits = limits.Limits()
+        self._condition = threading.Condition()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._stopped = False
+        self._paused = False
+        self.generation = 0  # Incremented on every pause
+        self._thread = threading.Thread(target=self.run_timers, daemon=True)
+        self._thread.start()
+
+    def configure(self, config):
+        """Apply limits from workload, jobs parked on limits that were raised or removed are admitted"""
+
+        with self._condition:
+            self.limits.configure(config)
+            self._wake(self.limits)
+
+    def submit(self, func, task, planned=None):
+        """Hand job run planned at datetime over to executor, returns without waiting for limits"""
+
+        with self._condition:
+            self._admit(Pending(func, task, self.limits.for_task(task), self.generation, planned=planned))
+
+    def pause(self, cancel=False):
+        """Stop starting job runs and drop waiting ones, runs in flight are left to finish or aborted if cancel"""
+
+        with self._condition:
+            self._paused = True
+            self.generation += 1
+            dropped = [pending for _, _, pending, _ in self._timers]
+            for _, _, _, reason in self._timers:
+                metrics.deferred_jobs.dec(reason)
+            self._timers.clear()
+            for limit in self.limits:
+                metrics.deferred_jobs.dec("concurrency", amount=len(limit.waiting))
+                dropped.extend(limit.waiting)
+                limit.waiting.clear()
+        for pending in dropped:
+            if pending.attempt == 0:
+                metrics.schedule.discarded(pending.task.get("id"), pending.planned)
+        if cancel:
+            dispatch.sessions.abort()
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+
+    def saturation(self):
+        """Share of workers sending requests"""
+
+        return metrics.in_flight.active / self.workers
+
+    def _admit(self, pending):
+        """Start job run if its limits allow it, otherwise park or defer it, must hold condition"""
+
+        if self._stopped or self._paused or pending.generation != self.generation:
+            if pending.attempt == 0:
+                metrics.schedule.discarded(pending.task.get("id"), pending.planned)
+            return
+        for limit in pending.limits:
+            if limit.full():
+                limit.waiting.append(pending)
+                metrics.deferred_jobs.inc("concurrency")
+                return
+
+        if not pending.reserved:
+            pending.reserved = True
+            now = time.monotonic()
+            delay = max([limit.reserve(now) for limit in pending.limits], default=0)
+            if delay > 0:
+                self._defer(pending, delay, "rate")
+                return
+
+        for limit in pending.limits:
+            limit.active += 1
+        self.pool.submit(self._run, pending)
+
+    def _defer(self, pending, delay, reason):
+        """Admit job again by timer after delay in seconds, must hold condition"""
+
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), pending, reason))
+        metrics.deferred_jobs.inc(reason)
+        self._condition.notify()
+
+    def _wake(self, limits):
+        """Admit parked jobs while limits have free slots, must hold condition"""
+
+        for limit in limits:
+            while limit.waiting and not limit.full():
+                metrics.deferred_jobs.dec("concurrency")
+                self._admit(limit.waiting.popleft())
+
+    def _run(self, pending):
+        job_id = pending.task.get("id")
+        retry = False
+        try:
+            if pending.generation != self.generation:
+                if pending.attempt == 0:
+                    metrics.schedule.discarded(job_id, pending.planned)
+                return  # Executor was paused while run was queued in pool
+            if pending.attempt == 0:
+                metrics.schedule.started(job_id, pending.planned)
+            with tracing.traced(tracing.Trace(pending.task, pending.submitted)) as trace:
+                trace.dequeued()
+                retry = dispatch.failed(pending.func(pending.task))
+            if not retry:
+                checkpoint.succeeded(pending.task, pending.planned)
+        except CircuitOpenError as e:
+            logger.warning(f"job {job_id} skipped: {e}")
+        except dispatch.RequestCancelled as e:
+            logger.info(f"job {job_id} cancelled: {e}")
+        except Exception as e:
+            logger.error(f"job {job_id} failed: {e}")
+            retry = True
+        finally:
+            with self._condition:
+                for limit in pending.limits:
+                    limit.active -= 1
+                self._wake(pending.limits)
+
+        if not retry or pending.generation != self.generation:
+            return
+        delay = dispatch.retry_delay(pending.task, pending.attempt + 1)
+        if delay is not None:
+            logger.info(f"job {job_id} will be retried in {delay:.1f}s, attempt {pending.attempt + 1}")
+            with self._condition:
+                next_run = Pending(
+                    pending.func,
+                    pending.task,
+                    self.limits.for_task(pending.task),
+                    pending.generation,
+                    pending.attempt + 1,
+                    pending.planned,
+                )
+                self._defer(next_run, delay, "retry")
+
+    def run_timers(self):
+        """Thread to admit rate limited jobs once their tokens are due and retries once backoff passes"""
+
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    delay = self._timers[0][0] - time.monotonic() if self._timers else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._stopped:
+                    return
+                _, _, pending, reason = heapq.heappop(self._timers)
+                metrics.deferred_jobs.dec(reason)
+                if reason == "retry":
+                    pending.submitted = time.monotonic()  # Backoff is not queueing
+                self._admit(pending)
+
+    def shutdown(self, wait=True):
+        """Drop waiting jobs and stop workers"""
+
+        self.pause()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        # Runs queued in pool are not cancelled, they see executor was paused and record they were dropped
+        self.pool.shutdown(wait=wait)
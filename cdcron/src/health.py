@@ -0,0 +1,40 @@
+import os
+
+import metrics
+
+# Scheduling lag in seconds over which instance reports warning, and critical, 0 disables critical
+HEALTH_LAG_WARN = float(os.getenv("HEALTH_LAG_WARN", 10))
+HEALTH_LAG_FAIL = float(os.getenv("HEALTH_LAG_FAIL", 0))
+
+# Share of dispatch capacity in use over which instance reports warning
+HEALTH_SATURATION_WARN = float(os.getenv("HEALTH_SATURATION_WARN", 0.9))
+
+PASSING, WARNING, CRITICAL = "passing", "warning", "critical"
+LEVELS = (PASSING, WARNING, CRITICAL)
+
+# Callable returning share of dispatch capacity in use, set by scheduler that dispatches jobs
+saturation = None
+
+
+def status(renewal_late=False):
+    """Health of this instance as consul check status and output, from its own state since last call
+
+    renewal_late is True when previous report reached consul later than expected.
+    """
+
+    lag = metrics.schedule.lag()
+    used = saturation() if saturation else 0.0
+    problems = []
+    if HEALTH_LAG_FAIL and lag > HEALTH_LAG_FAIL:
+        problems.append((CRITICAL, f"scheduling lag over {HEALTH_LAG_FAIL:g}s"))
+    elif lag > HEALTH_LAG_WARN:
+        problems.append((WARNING, f"scheduling lag over {HEALTH_LAG_WARN:g}s"))
+    if used > HEALTH_SATURATION_WARN:
+        problems.append((WARNING, f"dispatch saturated over {HEALTH_SATURATION_WARN:.0%}"))
+    if renewal_late:
+        problems.append((WARNING, "session renewal late"))
+
+    output = f"lag {lag:.3f}s, saturation {used:.0%}"
+    if problems:
+        output += f": {', '.join(problem for _, problem in problems)}"
+    return max((level for level, _ in problems), key=LEVELS.index, default=PASSING), output
@@ -2,17 +2,54 @@ import atexit
 import logging
 import os
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+import profiler
 
 logger = logging.getLogger(__name__)
 
 
 class StubRequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            self._reply(200, metrics.registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/debug/profile" and profiler.PROFILE_ENABLED:
+            self._profile(parse_qs(url.query))
+        else:
+            self._reply(200, "Ok")
+
+    def _profile(self, query):
+        """Run sampling profiler for seconds given in query and send collapsed stacks as download"""
+
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= profiler.PROFILE_MAX_SECONDS:
+            self._reply(400, f"seconds must be between 0 and {profiler.PROFILE_MAX_SECONDS:g}\n")
+            return
+        logger.info(f"profiling for {seconds:g}s")
+        try:
+            stacks = profiler.sample(seconds)
+        except profiler.ProfilerBusy as e:
+            self._reply(409, f"{e}\n")
+            return
+        filename = time.strftime("cdcron-profile-%Y%m%d-%H%M%S.txt")
+        self._reply(200, stacks, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+    def _reply(self, status, body, content_type="text/plain", headers=None):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(b"Ok")
+        self.wfile.write(body)
 
     def log_message(self, format, *args):
         return  # Suppress logging to console
@@ -21,7 +58,8 @@ class StubRequestHandler(BaseHTTPRequestHandler):
 class HealthCheckServer:
     def __init__(self):
         self.port = int(os.getenv("HEALTHCHECK_PORT", 8080))
-        self.server = HTTPServer(("0.0.0.0", self.port), StubRequestHandler)
+        self.server = ThreadingHTTPServer(("0.0.0.0", self.port), StubRequestHandler)
+        self.server.daemon_threads = True  # Concurrent scrapes and checks don't wait for each other
         self.server_thread = threading.Thread(target=self.server.serve_forever)
         self.server_thread.daemon = True
         atexit.register(self.stop)
@@ -0,0 +1,118 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import metrics
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+
+# Default share of successful job runs that are logged, can be overridden per job with log_sample_rate
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1))
+
+# Default max number of successful runs of one job logged per second, 0 is unlimited, per job log_rate_limit
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", 0))
+
+# Record attributes added to JSON output when set, job results and slow executions carry them in extra
+JSON_FIELDS = ("job", "method", "url", "status", "response", "truncated", "duration", "phases")
+
+_listener = None
+_budgets = {}  # Job ID to remaining log records and time budget was refilled
+_budgets_lock = threading.Lock()
+
+
+class JSONFormatter(logging.Formatter):
+    """Format record as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in JSON_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records over to listener thread as they are, dropping records below warning when queue is full
+
+    Message is formatted by listener, so logging thread only pays for creating the record. Errors are
+    written right away by direct handler, as they often precede os._exit that never drains the queue.
+    """
+
+    def __init__(self, queue, direct):
+        super().__init__(queue)
+        self.direct = direct
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.ERROR:
+            self.direct.handle(record)
+            return
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)  # Failures are never dropped, logging thread waits for room instead
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.log_records_dropped.inc()
+
+
+def configure():
+    """Route all logging through queue drained by one thread writing to stderr, safe to call more than once"""
+
+    global _listener
+    if _listener is not None:
+        return
+
+    # Read env variables
+    log_format = os.getenv("LOG_FORMAT", "text").lower()
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    queue_size = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(JSONFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT))
+    records = queue.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+    atexit.register(_listener.stop)  # Writes out records left in queue
+    logging.basicConfig(level=level, handlers=[DroppingQueueHandler(records, stream)], force=True)
+
+
+def sampled(task):
+    """True if successful run of task should be logged, by its sample rate and rate limit"""
+
+    rate = float(task.get("log_sample_rate", LOG_SAMPLE_RATE))
+    if rate < 1 and random.random() >= rate:
+        return False
+    limit = float(task.get("log_rate_limit", LOG_RATE_LIMIT))
+    if limit <= 0:
+        return True
+
+    now = time.monotonic()
+    key = task.get("id", task["url"])
+    burst = max(limit, 1)
+    with _budgets_lock:
+        tokens, updated = _budgets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * limit)
+        if tokens < 1:
+            _budgets[key] = (tokens, now)
+            return False
+        _budgets[key] = (tokens - 1, now)
+    return True
+
@@ -0,0 +1,85 @@
+import collections
+import time
+from urllib.parse import urlsplit
+
+
+class Limit:
+    """Concurrency slots and token bucket of one target host or job group"""
+
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        self.active = 0
+        self.waiting = collections.deque()  # Jobs parked until a slot is released
+        self.tokens = None
+        self.updated = time.monotonic()
+        self.configure(concurrency, rate, burst)
+
+    def configure(self, concurrency=None, rate=None, burst=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        if self.tokens is None or self.tokens > self.burst:
+            self.tokens = self.burst
+
+    def full(self):
+        return self.concurrency is not None and self.active >= self.concurrency
+
+    def reserve(self, now):
+        """Take one token, returns seconds until it is actually available, tokens may go negative"""
+
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Limits:
+    """Limits declared in workload, looked up by target host and job group
+
+    Config looks like {"hosts": {"api:8080": {"concurrency": 4, "rate": 10, "burst": 20}, "*": {...}},
+    "groups": {"reports": {"concurrency": 2}}}. Host "*" applies to every host without own limits,
+    each host still gets separate slots and bucket.
+    """
+
+    def __init__(self):
+        self.config = {"hosts": {}, "groups": {}}
+        self._limits = {}
+
+    def configure(self, config):
+        """Apply new config, limits that still exist keep their in-flight counters and tokens"""
+
+        self.config = config
+        for key, limit in self._limits.items():
+            settings = self._settings(*key)
+            if settings is not None:
+                limit.configure(**settings)
+            else:
+                limit.configure()  # Unlimited now, executor admits jobs parked on it
+
+    def _settings(self, kind, name):
+        if kind == "group":
+            return self.config["groups"].get(name)
+        hosts = self.config["hosts"]
+        return hosts.get(name) or hosts.get(name.rsplit(":", 1)[0]) or hosts.get("*")
+
+    def for_task(self, task):
+        """Limits that apply to task, empty list if task is unlimited"""
+
+        keys = [("host", urlsplit(task["url"]).netloc)]
+        if "group" in task:
+            keys.append(("group", str(task["group"])))
+
+        limits = []
+        for key in keys:
+            limit = self._limits.get(key)
+            if limit is None:
+                settings = self._settings(*key)
+                if settings is None:
+                    continue
+                limit = self._limits[key] = Limit(**settings)
+            limits.append(limit)
+        return limits
+
+    def __iter__(self):
+        return iter(self._limits.values())
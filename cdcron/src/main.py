@@ -1,22 +1,28 @@
 import logging
+import os
 
 import consul
 import healthcheck
+import joblog
 
-from cdcron import cdcron
+from cdcron import cdcron, load_workload
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-    handlers=[logging.StreamHandler()],
-)
+joblog.configure()
 logger = logging.getLogger("main")
 
 logger.info(f"app started")
 
-healthcheck.HealthCheckServer()
+if os.getenv("HEALTHCHECK_SERVER", "true").lower() == "true":
+    healthcheck.HealthCheckServer()  # Can be left out with TTL health checks, consul doesn't connect to instance then
 consul = consul.Consul()
+workload_cache = load_workload(consul)  # Followers keep compiled jobs ready for takeover
+
+if consul.sharded:
+    cdcron(workload_cache, consul)  # Every instance schedules jobs of shards it owns
+
+if os.getenv("WARM_STANDBY", "true").lower() == "true":
+    cdcron(workload_cache, consul, standby=True)  # Followers keep paused scheduler ready for takeover
 
 while True:
-    while consul.is_leader:
-        cdcron()
+    consul.wait_for_leadership()
+    cdcron(workload_cache, consul)  # Returns when leadership is lost
@@ -0,0 +1,297 @@
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base of metrics, every metric has own lock so updates of different metrics never contend"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+job_executions = registry.register(
+    Counter("cdcron_job_executions_total", "Job executions by job and response status class", ("job", "status"))
+)
+request_duration = registry.register(
+    Histogram("cdcron_request_duration_seconds", "Duration of job HTTP requests", ("method", "host"))
+)
+schedule_lag = registry.register(
+    Histogram("cdcron_schedule_lag_seconds", "Actual fire time minus planned fire time of jobs", buckets=LAG_BUCKETS)
+)
+misfires = registry.register(Counter("cdcron_misfires_total", "Job runs skipped by scheduler", ("job", "reason")))
+catchup_runs = registry.register(
+    Counter("cdcron_catchup_runs_total", "Missed job runs dispatched from checkpoints after takeover", ("job",))
+)
+queue_depth = registry.register(Gauge("cdcron_executor_queue_depth", "Job runs submitted but not started yet"))
+deferred_jobs = registry.register(
+    Gauge("cdcron_executor_deferred_jobs", "Job runs waiting for concurrency slot, rate limit token or retry backoff", ("reason",))
+)
+circuit_state = registry.register(
+    Gauge("cdcron_circuit_state", "Circuit breaker state of target host, 0 closed, 1 half-open, 2 open", ("host",))
+)
+session_renew_duration = registry.register(
+    Histogram("cdcron_consul_session_renew_seconds", "Round trip of consul session renewals")
+)
+lock_watch_duration = registry.register(
+    Histogram(
+        "cdcron_consul_lock_watch_seconds",
+        "Round trip of lock watch blocking queries, including time waiting for changes",
+        buckets=DEFAULT_BUCKETS + (30, 60, 120),
+    )
+)
+leader = registry.register(Gauge("cdcron_leader", "1 if this instance is the leader, 0 otherwise"))
+leader.set(0)
+owned_shards = registry.register(Gauge("cdcron_owned_shards", "Number of shards owned by this instance"))
+demotion_duration = registry.register(
+    Gauge("cdcron_demotion_pause_seconds", "Time from detected loss of leadership until dispatch was paused")
+)
+log_records_dropped = registry.register(
+    Counter("cdcron_log_records_dropped_total", "Log records dropped because log queue was full")
+)
+requests_in_flight = registry.register(Gauge("cdcron_requests_in_flight", "Job HTTP requests in flight"))
+concurrency = registry.register(
+    Histogram(
+        "cdcron_request_concurrency",
+        "Job HTTP requests in flight when a request starts, including it, its top buckets show peak concurrency",
+        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+    )
+)
+request_phases = registry.register(
+    Histogram(
+        "cdcron_request_phase_seconds",
+        "Time job runs spent in each phase: queue, dns, connect, tls, ttfb, body and log",
+        ("phase",),
+        buckets=(0.0005,) + DEFAULT_BUCKETS + (30, 60),
+    )
+)
+worker_restarts = registry.register(
+    Counter("cdcron_worker_restarts_total", "Worker processes restarted after they exited unexpectedly")
+)
+takeover_dispatch = registry.register(
+    Gauge(
+        "cdcron_takeover_first_dispatch_seconds",
+        "Delay of first job started after this instance became leader, from leadership or its planned time, whichever is later",
+    )
+)
+
+
+def status_class(status_code):
+    """Status code class label like '2xx', 'error' when request failed without response"""
+
+    if status_code is None:
+        return "error"
+    return f"{status_code // 100}xx"
+
+
+class ScheduleTracker:
+    """Follows job runs from submission to start to measure scheduling lag and queue depth
+
+    Runs are identified by job ID and planned fire time they carry, so overlapping runs of one job are told
+    apart. Schedulers record submission of every run before handing it over, so runs start or are dropped
+    only after their submission is known, runs without planned fire time are not tracked.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # Job ID and planned fire time of runs waiting to start to start of their lag and count
+        self._worst = 0.0  # Longest lag of runs started since last call of lag()
+        self.active_since = 0.0  # Runs planned before this moment were missed by another instance, not this one
+        self._takeover = None
+
+    def took_over(self):
+        """Record moment this instance became leader, first job started after it is reported as takeover delay"""
+
+        self.active_since = self._takeover = time.time()
+
+    def submitted(self, job_id, planned, catchup=False):
+        """Record run of job planned at datetime handed to executor
+
+        Lag of caught up runs, planned before this instance scheduled them, is counted from their submission.
+        """
+
+        key = (job_id, planned)
+        with self._lock:
+            since, count = self._pending.get(key, (time.time() if catchup else planned.timestamp(), 0))
+            self._pending[key] = (since, count + 1)
+        queue_depth.inc()
+
+    def _take(self, job_id, planned):
+        """Remove run from pending ones, returns start of its lag or None if it was not submitted, must hold lock"""
+
+        key = (job_id, planned)
+        if key not in self._pending:
+            return None
+        since, count = self._pending[key]
+        if count > 1:
+            self._pending[key] = (since, count - 1)
+        else:
+            del self._pending[key]
+        return since
+
+    def discarded(self, job_id, planned):
+        """Record run of job planned at datetime dropped before it started"""
+
+        with self._lock:
+            if self._take(job_id, planned) is None:
+                return
+        queue_depth.dec()
+
+    def started(self, job_id, planned):
+        """Record start of run of job planned at datetime, observing lag from its planned fire time"""
+
+        now = time.time()
+        with self._lock:
+            since = self._take(job_id, planned)
+            if since is None:
+                return
+            self._worst = max(self._worst, now - since)
+        queue_depth.dec()
+        schedule_lag.observe(max(0.0, now - planned.timestamp()))
+        takeover, self._takeover = self._takeover, None
+        if takeover is not None:
+            takeover_dispatch.set(max(0.0, now - max(takeover, planned.timestamp())))
+
+    def clear(self):
+        """Forget runs still waiting to start, their scheduler and executor were stopped so they never will"""
+
+        with self._lock:
+            waiting = sum(count for _, count in self._pending.values())
+            self._pending.clear()
+        queue_depth.dec(amount=waiting)
+
+    def lag(self):
+        """Longest lag since last call, of runs started meanwhile and of runs still waiting to start"""
+
+        now = time.time()
+        with self._lock:
+            worst, self._worst = self._worst, 0.0
+            for since, _ in self._pending.values():
+                worst = max(worst, now - since)
+        return max(0.0, worst)
+
+
+class InFlightTracker:
+    """Counts job HTTP requests in flight, observing concurrency every time one starts"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+
+    def started(self):
+        with self._lock:
+            self.active += 1
+            active = self.active
+        requests_in_flight.set(active)
+        concurrency.observe(active)
+
+    def finished(self):
+        with self._lock:
+            self.active -= 1
+            active = self.active
+        requests_in_flight.set(active)
+
+
+schedule = ScheduleTracker()
+in_flight = InFlightTracker()
@@ -0,0 +1,215 @@
+import itertools
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+
+import dispatch
+import executor
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+
+# Seconds worker processes get to finish requests in flight when pool stops, they are killed after that
+STOP_TIMEOUT = 30
+
+
+class WorkerError(Exception):
+    """Request failed in worker process or worker process exited while it was in flight"""
+
+
+class WorkerProcess:
+    """Handle of one worker process, restarted by its receiver thread whenever it exits"""
+
+    def __init__(self, index, threads, pool):
+        self.index = index
+        self.threads = threads
+        self.pool = pool
+        self.pending = {}  # Sequence number of request in flight to its future
+        self.sent = {}  # Job ID to task worker knows, task is sent again only when it changed
+        self.alive = False
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        parent, child = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_PATH, str(child.fileno()), str(self.threads)], pass_fds=(child.fileno(),)
+        )
+        child.close()
+        self.conn = Connection(parent.detach())
+        self.sent = {}
+        self.alive = True
+        threading.Thread(target=self.run_receiver, args=(self.conn, self.process), daemon=True).start()
+        logger.debug(f"worker {self.index} started with pid {self.process.pid}")
+
+    def send(self, message):
+        with self._lock:
+            self.conn.send(message)
+
+    def run(self, seq, method, task, token):
+        """Send job descriptor to worker, task itself only if worker doesn't know it yet, returns future of summary"""
+
+        future = Future()
+        job_id = task.get("id", task["url"])
+        with self._lock:
+            self.pending[seq] = future
+            known = self.sent.get(job_id) is task
+            self.sent[job_id] = task
+            try:
+                self.conn.send(("run", seq, job_id, method, None if known else task, token))
+            except OSError as e:
+                del self.pending[seq]
+                future.set_exception(WorkerError(f"worker {self.index} is not running: {e}"))
+        return future
+
+    def run_receiver(self, conn, process):
+        """Thread to resolve futures with summaries sent by worker, restarting worker when it exits"""
+
+        while True:
+            try:
+                summary = conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self.pending.pop(summary[0], None)
+            if future is not None:
+                future.set_result(summary[1:])
+
+        code = process.wait()
+        conn.close()
+        with self._lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(WorkerError(f"worker {self.index} exited with code {code}"))
+        if self.pool.stopped:
+            return
+        logger.warning(f"worker {self.index} exited with code {code}, {len(pending)} requests lost, restarting")
+        metrics.worker_restarts.inc()
+        time.sleep(1)  # Worker crashing on start must not spin
+        with self._lock:
+            if not self.pool.stopped:
+                self._start()
+
+    def stop(self, timeout):
+        """Let worker finish requests in flight and exit, kill it after timeout"""
+
+        try:
+            self.send(("stop",))
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class ProcessPool:
+    """Worker processes sending job requests, each with own connection pools
+
+    Scheduler process sends compact descriptor of every run, job ID, method and fencing token, full task
+    only the first time worker gets the job or after it changed. Worker sends back status, kept part of
+    body, duration and phases, so metrics and logging stay in scheduler process.
+    """
+
+    def __init__(self, threads):
+        # Read env variables
+        self.size = int(os.getenv("PROCESS_WORKERS", os.cpu_count() or 1))
+
+        self.stopped = False
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._workers = [WorkerProcess(i, threads, self) for i in range(self.size)]
+        logger.info(f"started {self.size} worker processes")
+
+    def _pick(self):
+        """Running worker with fewest requests in flight"""
+
+        with self._lock:
+            alive = [worker for worker in self._workers if worker.alive]
+            if not alive:
+                raise WorkerError("no worker process is running")
+            return min(alive, key=lambda worker: len(worker.pending))
+
+    def request(self, method, task):
+        """Execute HTTP request described by task in worker process, recording its result, returns status code"""
+
+        token = dispatch.fence(task)
+        breaker = dispatch.allow(task)
+        started = time.monotonic()
+        metrics.in_flight.started()
+        try:
+            summary = self._pick().run(next(self._sequence), method, task, token).result()
+        except WorkerError:
+            # Lost worker process tells nothing about target
+            dispatch.record(method, task, None, time.monotonic() - started, dispatch.blamed(breaker, False))
+            raise
+        finally:
+            metrics.in_flight.finished()
+        status_code, body, seconds, elapsed, phases, error, transport, cancelled = summary
+
+        trace = tracing.current()
+        if trace is not None:
+            for phase, value in phases.items():
+                trace.add(phase, value)
+            trace.add("queue", time.monotonic() - started - elapsed)  # Passing descriptor and summary between processes
+        if cancelled:
+            dispatch.cancelled(task, breaker)
+            raise dispatch.RequestCancelled(error)
+        if error is not None:
+            dispatch.record(method, task, None, seconds, dispatch.blamed(breaker, transport))
+            raise WorkerError(error)
+        dispatch.record(method, task, status_code, seconds, breaker)
+        dispatch.log_response(method, task, status_code, body, dispatch.body_limit(task))
+        return status_code
+
+    def broadcast(self, message):
+        for worker in self._workers:
+            try:
+                worker.send(message)
+            except OSError:
+                pass  # Restarted worker starts without state anyway
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Stop all workers, letting them finish requests in flight"""
+
+        self.stopped = True
+        threads = [threading.Thread(target=worker.stop, args=(timeout,)) for worker in self._workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class ProcessExecutor(executor.JobExecutor):
+    """Job executor sending requests from pool of worker processes
+
+    Limits, retries, checkpoints, metrics and logging stay in this process, its workers only wait for
+    results of worker processes, so TLS, encoding of payloads and reading of responses use other cores.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.processes = ProcessPool(self.workers)
+
+    def request(self, method, task):
+        return self.processes.request(method, task)
+
+    def pause(self, cancel=False):
+        super().pause(cancel)
+        if cancel:
+            self.processes.broadcast(("abort",))
+
+    def warm(self, urls):
+        """Open connections to target hosts in every worker process"""
+
+        self.processes.broadcast(("warm", list(urls)))
+
+    def shutdown(self, wait=True):
+        super().shutdown(wait)
+        self.processes.stop(STOP_TIMEOUT if wait else 0)
@@ -0,0 +1,53 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Serve sampling profiler on healthcheck server, off by default as endpoint is unauthenticated
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+
+# Longest profile that can be requested in seconds and interval between samples
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+
+_lock = threading.Lock()  # Only one profile runs at a time
+
+
+class ProfilerBusy(Exception):
+    """Another profile is already running"""
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample(seconds, interval=PROFILE_INTERVAL):
+    """Sample stacks of all threads for seconds without stopping them
+
+    Returns collapsed stacks, one 'thread;outermost;...;innermost count' line per distinct stack, as read by
+    flamegraph.pl and speedscope. Threads are sampled only when they hold the GIL or wait for it.
+    """
+
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("profile is already running")
+    try:
+        counts = collections.Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
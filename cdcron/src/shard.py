@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+
+
+def _hash(value):
+    """Stable 64 bit hash of string, same on every instance"""
+
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+def shard_of(job_id, shard_count):
+    """Shard number that job belongs to"""
+
+    return _hash(job_id) % shard_count
+
+
+class HashRing:
+    """Consistent hash ring mapping shards to instances
+
+    Every instance is placed on the ring multiple times (virtual nodes), so when an
+    instance joins or leaves only shards adjacent to its points change owner.
+    """
+
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(members)
+        self._points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._keys = [point for point, _ in self._points]
+
+    def owner(self, key):
+        """Instance owning key, None if ring is empty"""
+
+        if not self._points:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._points)
+        return self._points[index][1]
@@ -0,0 +1,123 @@
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Job runs taking longer than this many seconds from submission to logged result are logged with their phases, 0 disables
+SLOW_EXECUTION_THRESHOLD = float(os.getenv("SLOW_EXECUTION_THRESHOLD", 10))
+
+# Phases of job run in the order they happen
+PHASES = ("queue", "dns", "connect", "tls", "ttfb", "body", "log")
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """Seconds one job run spent in each phase, filled in by whichever code runs that phase
+
+    Phases that did not happen, like connecting on reused connection, are left out.
+    """
+
+    __slots__ = ("task", "submitted", "phases", "_sent", "_recorded", "_received")
+
+    def __init__(self, task, submitted=None):
+        self.task = task
+        self.submitted = time.monotonic() if submitted is None else submitted  # Start of queue phase
+        self.phases = {}
+        self._sent = self._recorded = self._received = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + max(0.0, seconds)
+
+    def connecting(self):
+        """Seconds spent opening connections so far"""
+
+        return self.phases.get("dns", 0.0) + self.phases.get("connect", 0.0) + self.phases.get("tls", 0.0)
+
+    def dequeued(self):
+        """Mark end of queue phase"""
+
+        self.add("queue", time.monotonic() - self.submitted)
+
+    def sending(self):
+        """Mark request about to be sent, phases recorded until its headers arrive are not counted as ttfb"""
+
+        self._sent = time.monotonic()
+        self._recorded = sum(self.phases.values())
+
+    def received(self):
+        """Mark response headers received"""
+
+        self._received = time.monotonic()
+        self.add("ttfb", self._received - self._sent - (sum(self.phases.values()) - self._recorded))
+
+    def read(self):
+        """Mark response body read"""
+
+        if self._received is not None:
+            self.add("body", time.monotonic() - self._received)
+
+
+def current():
+    """Trace of job run executing in current thread or coroutine, None outside of job runs"""
+
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(trace):
+    """Make trace current for job run executed in block"""
+
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def traced(trace):
+    """Make trace current for job run executed in block, observing its phases when block exits"""
+
+    try:
+        with recording(trace):
+            yield trace
+    finally:
+        finish(trace)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add time spent in block to phase of current trace"""
+
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        trace = _current.get()
+        if trace is not None:
+            trace.add(name, time.monotonic() - started)
+
+
+def finish(trace):
+    """Observe phases of finished job run and log it if it was slow"""
+
+    for name, seconds in trace.phases.items():
+        metrics.request_phases.observe(seconds, name)
+    total = time.monotonic() - trace.submitted
+    if not SLOW_EXECUTION_THRESHOLD or total < SLOW_EXECUTION_THRESHOLD:
+        return
+    phases = {name: round(trace.phases[name], 6) for name in PHASES if name in trace.phases}
+    logger.warning(
+        "job %s slow execution of %s took %.3fs: %s",
+        trace.task.get("id"),
+        trace.task["url"],
+        total,
+        ", ".join(f"{name} {seconds:.3f}s" for name, seconds in phases.items()) or "no request sent",
+        extra={"job": trace.task.get("id"), "url": trace.task["url"], "duration": round(total, 6), "phases": phases},
+    )
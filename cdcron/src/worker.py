@@ -0,0 +1,76 @@
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+
+import dispatch
+import joblog
+import tracing
+
+
+class Worker:
+    """Receives job descriptors, runs their requests on own thread pool and connection pools, sends back summaries"""
+
+    def __init__(self, conn, threads):
+        self.conn = conn
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker")
+        self.tasks = {}  # Job ID to task, task is sent once and again only after it changed
+        self._send_lock = threading.Lock()
+
+    def run(self):
+        """Handle messages until scheduler process asks to stop or goes away, then finish requests in flight"""
+
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == "run":
+                _, seq, job_id, method, task, token = message
+                if task is not None:
+                    self.tasks[job_id] = task
+                self.pool.submit(self.execute, seq, method, self.tasks[job_id], token, time.monotonic())
+            elif kind == "abort":
+                dispatch.sessions.abort()
+            elif kind == "warm":
+                self.pool.submit(dispatch.sessions.warm, message[1])
+            elif kind == "stop":
+                break
+        self.pool.shutdown(wait=True)
+        dispatch.sessions.close()
+
+    def execute(self, seq, method, task, token, received):
+        """Send request of job and report status, kept part of body, duration and phases or error"""
+
+        trace = tracing.Trace(task, received)
+        status_code = body = error = None
+        cancelled = transport = False
+        with tracing.recording(trace):
+            trace.dequeued()
+            started = time.monotonic()
+            try:
+                status_code, body = dispatch.send(method, task, token)
+            except dispatch.RequestCancelled as e:
+                cancelled, error = True, str(e)
+            except Exception as e:
+                error, transport = str(e), isinstance(e, dispatch.TRANSPORT_ERRORS)
+        finished = time.monotonic()
+        summary = (seq, status_code, body, finished - started, finished - received, trace.phases, error, transport, cancelled)
+        with self._send_lock:
+            try:
+                self.conn.send(summary)
+            except OSError:
+                pass  # Scheduler process is gone
+
+
+def main():
+    """Entry point of worker process started by procpool: worker.py <fd of connection> <number of threads>"""
+
+    joblog.configure()
+    Worker(Connection(int(sys.argv[1])), int(sys.argv[2])).run()
+
+
+if __name__ == "__main__":
+    main()
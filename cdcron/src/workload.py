@@ -0,0 +1,344 @@
+import base64
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+
+import checkpoint
+
+logger = logging.getLogger(__name__)
+
+# Default width in seconds of window fire times of jobs are spread over, 0 fires jobs exactly on schedule
+SMEAR_WINDOW = float(os.getenv("SMEAR_WINDOW", 0))
+
+# Optional numeric fields of task, with accepted types, description of allowed values and check of range
+NUMBER_FIELDS = {
+    "retries": (int, "non-negative integer", lambda value: value >= 0),
+    "retry_backoff": ((int, float), "non-negative number", lambda value: value >= 0),
+    "max_body_bytes": (int, "non-negative integer", lambda value: value >= 0),
+    "log_sample_rate": ((int, float), "number from 0 to 1", lambda value: 0 <= value <= 1),
+    "log_rate_limit": ((int, float), "non-negative number", lambda value: value >= 0),
+    "connect_timeout": ((int, float), "positive number", lambda value: value > 0),
+    "read_timeout": ((int, float), "positive number", lambda value: value > 0),
+}
+
+
+class WorkloadError(Exception):
+    """Workload is malformed and can't be scheduled"""
+
+
+class Job:
+    """Compiled workload entry, ready to be added to scheduler"""
+
+    def __init__(self, id, method, task, trigger, offset=0.0):
+        self.id = id
+        self.method = method
+        self.task = task
+        self.trigger = OffsetTrigger(trigger, offset) if offset else trigger
+        self.offset = offset
+        self.fingerprint = fingerprint(task)
+
+
+class OffsetTrigger(BaseTrigger):
+    """Trigger firing offset seconds after every fire time of wrapped trigger"""
+
+    def __init__(self, trigger, offset):
+        self.trigger = trigger
+        self.offset = offset
+        self._delta = datetime.timedelta(seconds=offset)
+
+    @property
+    def timezone(self):
+        return self.trigger.timezone
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is not None:
+            previous_fire_time -= self._delta
+        fire_time = self.trigger.get_next_fire_time(previous_fire_time, now - self._delta)
+        return fire_time + self._delta if fire_time is not None else None
+
+    def __str__(self):
+        return f"{self.trigger} +{self.offset}s"
+
+
+def load(path):
+    """Read JSON workload file"""
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def fingerprint(task):
+    """Hash of task definition, changes whenever any field of task changes"""
+
+    return hashlib.sha1(json.dumps(task, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def job_id(task):
+    """Stable ID of task, explicit 'id' field or hash of its method, url and cron
+
+    Other fields are left out, so editing headers, timeouts or data updates job instead of replacing it.
+    """
+
+    if "id" in task:
+        return str(task["id"])
+    identity = [str(task["method"]).upper(), task["url"], task["cron"]]
+    return hashlib.sha1(json.dumps(identity).encode("utf-8")).hexdigest()[:16]
+
+
+def with_ids(workload):
+    """Pair every task with unique stable ID, tasks with the same ID get numbered suffix in order of workload"""
+
+    seen = {}
+    jobs = []
+    for task in workload:
+        key = job_id(task)
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = f"{key}-{seen[key]}"
+        jobs.append((key, task))
+    return jobs
+
+
+def smear_offset(key, window):
+    """Offset of job within smear window, derived from its ID so it is the same on every instance and run
+
+    Offsets are multiples of 0.1 second, so jobs with identical schedule still share few fire times.
+    """
+
+    steps = int(window * 10)
+    if steps <= 0:
+        return 0.0
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:8], 16) % steps / 10
+
+
+@functools.lru_cache(maxsize=None)
+def cron_trigger(cron):
+    """Parse crontab expression once, identical expressions share one trigger"""
+
+    return CronTrigger.from_crontab(cron)
+
+
+def compile_jobs(workload, methods):
+    """Validate tasks and compile them into jobs keyed by stable ID, skipping unsupported methods"""
+
+    if not isinstance(workload, list):
+        raise WorkloadError("workload must be a JSON list of tasks")
+
+    for task in workload:
+        if not isinstance(task, dict) or not all(field in task for field in ("method", "url", "cron")):
+            raise WorkloadError(f"task must have 'method', 'url' and 'cron' fields: {task}")
+        if not isinstance(task["url"], str) or not isinstance(task["cron"], str):
+            raise WorkloadError(f"'url' and 'cron' of task must be strings: {task}")
+
+    jobs = {}
+    for key, task in with_ids(workload):
+        method = str(task["method"]).upper()
+        if method not in methods:
+            logger.warning(f"Method '{method}' not supported for task: {task}")
+            continue
+        window = task.get("smear", SMEAR_WINDOW)
+        if isinstance(window, bool) or not isinstance(window, (int, float)) or window < 0:
+            raise WorkloadError(f"'smear' of task {key} must be non-negative number of seconds: {window}")
+        for field, (kind, expected, valid) in NUMBER_FIELDS.items():
+            if field not in task:
+                continue
+            value = task[field]
+            if isinstance(value, bool) or not isinstance(value, kind) or not valid(value):
+                raise WorkloadError(f"'{field}' of task {key} must be {expected}: {value}")
+        if not isinstance(task.get("discard_body", False), bool):
+            raise WorkloadError(f"'discard_body' of task {key} must be true or false: {task['discard_body']}")
+        try:
+            jobs[key] = Job(key, method, dict(task, id=key), cron_trigger(task["cron"]), smear_offset(key, window))
+        except ValueError as e:
+            raise WorkloadError(f"invalid cron '{task['cron']}' of task {key}: {e}")
+        try:
+            checkpoint.policy(task)
+        except ValueError as e:
+            raise WorkloadError(f"invalid catch-up policy of task {key}: {e}")
+    return jobs
+
+
+def compile_limits(config):
+    """Validate limits section of workload, returns limits of hosts and job groups"""
+
+    limits = {"hosts": {}, "groups": {}}
+    if not isinstance(config, dict) or not config.keys() <= limits.keys():
+        raise WorkloadError("limits must be a JSON object with 'hosts' and 'groups' fields")
+    for kind, entries in config.items():
+        if not isinstance(entries, dict):
+            raise WorkloadError(f"limits '{kind}' must be a JSON object")
+        for name, settings in entries.items():
+            if not isinstance(settings, dict) or not settings.keys() <= {"concurrency", "rate", "burst"}:
+                raise WorkloadError(f"limit of {name} may have only 'concurrency', 'rate' and 'burst' fields: {settings}")
+            for field, value in settings.items():
+                number = (int, float) if field == "rate" else int  # Rate may be fractional, per second
+                if isinstance(value, bool) or not isinstance(value, number) or value <= 0:
+                    raise WorkloadError(f"'{field}' of limit {name} must be positive number: {value}")
+            limits[kind][str(name)] = dict(settings)
+    return limits
+
+
+def compile_workload(workload, methods):
+    """Compile list of tasks or object with 'jobs' and 'limits' fields, returns jobs and limits"""
+
+    if isinstance(workload, dict):
+        return compile_jobs(workload.get("jobs", []), methods), compile_limits(workload.get("limits", {}))
+    return compile_jobs(workload, methods), compile_limits({})
+
+
+class FileWatcher:
+    """Reload workload file when its mtime and content hash change"""
+
+    interval = 1  # Seconds between checks of file
+
+    def __init__(self, path, methods):
+        self.path = path
+        self.methods = methods
+        self._stat = None
+        self._digest = None
+
+    def load(self):
+        """Read and compile workload file, raises on invalid content"""
+
+        stat = os.stat(self.path)
+        with open(self.path, "rb") as f:
+            content = f.read()
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+        self._digest = hashlib.sha256(content).hexdigest()
+        return compile_workload(json.loads(content), self.methods)
+
+    def poll(self):
+        """Return newly compiled jobs and limits if file content changed, None if unchanged or invalid"""
+
+        try:
+            stat = os.stat(self.path)
+            if (stat.st_mtime_ns, stat.st_size) == self._stat:
+                return None
+            with open(self.path, "rb") as f:
+                content = f.read()
+            self._stat = (stat.st_mtime_ns, stat.st_size)
+            digest = hashlib.sha256(content).hexdigest()
+            if digest == self._digest:
+                return None
+            jobs, limits = compile_workload(json.loads(content), self.methods)
+        except (OSError, ValueError, WorkloadError) as e:
+            logger.error(f"workload {self.path} rejected, keeping current jobs: {e}")
+            return None
+
+        self._digest = digest
+        logger.info(f"workload {self.path} changed, {len(jobs)} jobs loaded")
+        return jobs, limits
+
+
+class ConsulWatcher:
+    """Read workload from consul KV prefix and watch it with blocking queries
+
+    Every key under prefix holds one task or list of tasks as JSON. Single task without
+    'id' field gets key name as its ID, so it keeps its identity when edited. Key '_limits'
+    holds limits of hosts and job groups.
+    """
+
+    interval = 0  # Blocking query itself waits for changes
+
+    def __init__(self, consul, prefix, methods):
+        self.consul = consul
+        self.prefix = prefix.strip("/") + "/"
+        self.methods = methods
+        self._index = 0
+        self._digest = None
+        self._attempt = 0
+
+    def _compile(self, response):
+        if response.status_code == 404:
+            logger.warning(f"workload prefix {self.prefix} is empty")
+            return compile_workload([], self.methods)
+        elif response.status_code != 200:
+            raise WorkloadError(f"failed to read workload prefix {self.prefix}, status code: {response.status_code}")
+
+        tasks = []
+        limits = {}
+        for entry in response.json():
+            if not entry.get("Value"):
+                continue  # Folder or empty key
+            name = entry["Key"][len(self.prefix) :]
+            try:
+                value = json.loads(base64.b64decode(entry["Value"]))
+            except ValueError as e:
+                raise WorkloadError(f"key {entry['Key']} is not an JSON: {e}")
+            if name == "_limits":
+                limits = value
+                continue
+            if isinstance(value, dict) and "id" not in value:
+                value = dict(value, id=name)
+            tasks.extend(value if isinstance(value, list) else [value])
+        return compile_workload({"jobs": tasks, "limits": limits}, self.methods)
+
+    def load(self):
+        """Read and compile workload, raises on invalid content"""
+
+        response, self._index = self.consul.client.blocking_query(f"/v1/kv/{self.prefix}?recurse=true", 0)
+        self._digest = hashlib.sha256(response.content).hexdigest()
+        return self._compile(response)
+
+    def poll(self):
+        """Block until workload changes, return newly compiled jobs and limits, None if unchanged or invalid"""
+
+        try:
+            response, index = self.consul.client.blocking_query(f"/v1/kv/{self.prefix}?recurse=true", self._index)
+            self._attempt = 0
+            if index == self._index:
+                return None
+            self._index = index
+            # Index of KV prefix moves on writes to any key, not only keys under prefix
+            digest = hashlib.sha256(response.content).hexdigest()
+            if digest == self._digest:
+                return None
+            self._digest = digest
+            jobs, limits = self._compile(response)
+        except WorkloadError as e:
+            logger.error(f"workload {self.prefix} rejected, keeping current jobs: {e}")
+            return None
+        except Exception as e:
+            self._attempt += 1
+            logger.error(f"error watching workload {self.prefix}: {e}")
+            time.sleep(self.consul.backoff(self._attempt))
+            return None
+
+        logger.info(f"workload {self.prefix} changed, {len(jobs)} jobs loaded")
+        return jobs, limits
+
+
+class WorkloadCache:
+    """Compiled jobs and limits kept up to date by watcher in background thread
+
+    Followers keep cache warm, so new leader starts scheduling without reading or parsing workload.
+    """
+
+    def __init__(self, watcher, watch=True):
+        self.watcher = watcher
+        self.jobs, self.limits = watcher.load()
+        self.changed = threading.Event()
+        if watch:
+            threading.Thread(target=self.run_watch, daemon=True).start()
+
+    def run_watch(self):
+        """Thread to swap in new jobs and limits every time watcher reports a valid change"""
+
+        while True:
+            try:
+                result = self.watcher.poll()
+            except Exception as e:
+                logger.error(f"error reloading workload, keeping current jobs: {e}")
+                result = None
+            if result is not None:
+                self.jobs, self.limits = result
+                self.changed.set()
+            time.sleep(self.watcher.interval)
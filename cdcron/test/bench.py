@@ -0,0 +1,300 @@
+"""Load test cdcron instances against fake consul and local targets on one machine
+
+Usage: python bench.py [tick] [slow] [failover] [--jobs 1000] [--env KEY=VALUE ...] [--output results.json]
+
+Scenarios:
+    tick      all jobs fire at the same minute boundary against fast target
+    slow      part of jobs target slow host, lag of jobs on fast host shows isolation
+    failover  leader freezes right before a tick, its session expires by TTL, standby takes over and fires missed runs
+"""
+
+import argparse
+import datetime
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+sys.path.insert(0, SRC)
+
+import workload  # noqa: E402
+from fakeconsul import FakeConsul  # noqa: E402
+from target import Target  # noqa: E402
+
+SCENARIOS = ("tick", "slow", "failover")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(predicate, timeout, interval=0.01):
+    """Poll predicate until it is true or timeout passes, returns last result"""
+
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if result or time.monotonic() > deadline:
+            return result
+        time.sleep(interval)
+
+
+def next_tick(lead):
+    """Timestamp of first minute boundary at least lead seconds away"""
+
+    boundary = datetime.datetime.now().replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    if (boundary - datetime.datetime.now()).total_seconds() < lead:
+        boundary += datetime.timedelta(minutes=1)
+    return boundary.timestamp()
+
+
+def sleep_until(timestamp):
+    time.sleep(max(0.0, timestamp - time.time()))
+
+
+def percentiles(values):
+    """Summary of values in seconds, empty when there are none"""
+
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = {f"p{int(q * 100)}": values[min(len(values) - 1, int(q * len(values)))] for q in (0.5, 0.95, 0.99)}
+    summary["max"] = values[-1]
+    return summary
+
+
+class Instance:
+    """cdcron main.py running in subprocess, output goes to log file"""
+
+    def __init__(self, name, env, logdir):
+        self.name = name
+        self.log = open(os.path.join(logdir, f"{name}.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(SRC, "main.py")], env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+    def freeze(self):
+        self.process.send_signal(signal.SIGSTOP)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+class Bench:
+    """Fake consul, workload file and instances shared by scenarios"""
+
+    def __init__(self, args):
+        self.args = args
+        self.consul = FakeConsul().start()
+        self.dir = tempfile.mkdtemp(prefix="cdcron-bench-")
+        self.workload = os.path.join(self.dir, "workload.json")
+        self.overrides = dict(item.split("=", 1) for item in args.env)
+        self.instances = []
+
+    def env(self, name, **defaults):
+        env = dict(
+            os.environ,
+            CONSUL_PORT=str(self.consul.port),
+            SERVICE_ID=name,
+            HEALTHCHECK_HOSTNAME="127.0.0.1",
+            HEALTHCHECK_PORT=str(free_port()),
+            WORKLOAD_FILE=self.workload,
+            SESSION_TTL="10",
+            SESSION_RENEW_INTERVAL="2",
+            LOG_LEVEL="WARNING",
+        )
+        env.update(defaults)
+        env.update(self.overrides)
+        return env
+
+    def start(self, name, **defaults):
+        instance = Instance(name, self.env(name, **defaults), self.dir)
+        self.instances.append(instance)
+        return instance
+
+    def stop_all(self):
+        for instance in self.instances:
+            instance.stop()
+        self.instances = []
+        self.consul.reset()  # Locks of killed instances must not outlive scenario
+
+    def write_jobs(self, tasks):
+        with open(self.workload, "w", encoding="utf-8") as f:
+            json.dump(tasks, f)
+
+    def planned(self, tasks, tick):
+        """Planned fire time of every job at tick, with smear offset of job"""
+
+        window = float(self.overrides.get("SMEAR_WINDOW", 0))
+        return {task["id"]: tick + workload.smear_offset(task["id"], task.get("smear", window)) for task in tasks}
+
+    def wait_leader(self, timeout=30):
+        if not wait_for(self.consul.leader_session, timeout):
+            raise RuntimeError(f"no leader elected in {timeout}s, see logs in {self.dir}")
+        with self.consul.state.cond:
+            return self.consul.state.kv["service/cdcron/leader"]["ModifyIndex"]
+
+    def collect(self, targets, planned, tick):
+        """Wait until every job planned at tick reached its target, returns lags by job and arrivals"""
+
+        def arrivals():
+            return [request for target in targets for request in target.requests if request[0] >= tick - 1]
+
+        deadline = max(planned.values()) + self.args.timeout
+        wait_for(lambda: len(arrivals()) >= len(planned), deadline - time.time(), 0.05)
+        lags = {}
+        for arrived, _, path, token in arrivals():
+            job = path.rsplit("/", 1)[-1]
+            if job in planned and job not in lags:
+                lags[job] = (arrived - planned[job], token)
+        return lags
+
+    def tasks(self, count, url, prefix="job"):
+        return [
+            {"id": f"{prefix}-{i}", "method": "GET", "cron": "* * * * *", "url": f"{url}/{prefix}-{i}", "discard_body": True}
+            for i in range(count)
+        ]
+
+    def tick(self):
+        target = Target(delay=self.args.delay).start()
+        tasks = self.tasks(self.args.jobs, target.url)
+        self.write_jobs(tasks)
+        try:
+            self.start("bench-a", WARM_STANDBY="false")
+            self.wait_leader()
+            tick = next_tick(self.args.lead)
+            planned = self.planned(tasks, tick)
+            target.reset()
+            lags = self.collect([target], planned, tick)
+        finally:
+            self.stop_all()
+            target.stop()
+
+        arrived = sorted(planned[job] + lag for job, (lag, _) in lags.items())
+        spread = arrived[-1] - arrived[0] if len(arrived) > 1 else 0.0
+        return {
+            "jobs": len(tasks),
+            "dispatched": len(lags),
+            "lag_seconds": percentiles([lag for lag, _ in lags.values()]),
+            "dispatch_spread_seconds": spread,
+            "throughput_per_second": len(arrived) / spread if spread else None,
+            "target_peak_concurrency": target.peak,
+        }
+
+    def slow(self):
+        fast = Target(delay=self.args.delay).start()
+        slow = Target(delay=self.args.slow_delay).start()
+        slow_jobs = int(self.args.jobs * self.args.slow_fraction)
+        tasks = self.tasks(self.args.jobs - slow_jobs, fast.url) + self.tasks(slow_jobs, slow.url, "slow")
+        self.write_jobs(tasks)
+        try:
+            self.start("bench-a", WARM_STANDBY="false")
+            self.wait_leader()
+            tick = next_tick(self.args.lead)
+            planned = self.planned(tasks, tick)
+            fast.reset()
+            slow.reset()
+            lags = self.collect([fast, slow], planned, tick)
+        finally:
+            self.stop_all()
+            fast.stop()
+            slow.stop()
+
+        return {
+            "jobs": len(tasks),
+            "slow_jobs": slow_jobs,
+            "slow_delay_seconds": self.args.slow_delay,
+            "dispatched": len(lags),
+            "fast_lag_seconds": percentiles([lag for job, (lag, _) in lags.items() if not job.startswith("slow")]),
+            "slow_lag_seconds": percentiles([lag for job, (lag, _) in lags.items() if job.startswith("slow")]),
+            "fast_peak_concurrency": fast.peak,
+            "slow_peak_concurrency": slow.peak,
+        }
+
+    def failover(self):
+        target = Target(delay=self.args.delay).start()
+        tasks = self.tasks(self.args.jobs, target.url)
+        self.write_jobs(tasks)
+        try:
+            # Missed tick must still be within grace time when standby takes over after session TTL
+            leader = self.start("bench-a", MISFIRE_GRACE_TIME="30")
+            token = self.wait_leader()
+            self.start("bench-b", MISFIRE_GRACE_TIME="30")
+            wait_for(lambda: len(self.consul.state.services) == 2, 30)
+            tick = next_tick(self.args.lead)
+            planned = self.planned(tasks, tick)
+
+            # Leader hangs just before tick, consul notices only when its session TTL expires, as if its node failed
+            sleep_until(tick - 1)
+            session = self.consul.leader_session()
+            leader.freeze()
+            frozen = time.time()
+            target.reset()
+            wait_for(lambda: self.consul.leader_session() not in (None, session), 60)
+            elected = time.time()
+            lags = self.collect([target], planned, tick)
+        finally:
+            self.stop_all()
+            target.stop()
+
+        taken_over = [planned[job] + lag for job, (lag, job_token) in lags.items() if job_token != str(token)]
+        return {
+            "jobs": len(tasks),
+            "leadership_seconds": elected - frozen,
+            "first_dispatch_seconds": min(taken_over) - frozen if taken_over else None,
+            "last_dispatch_seconds": max(taken_over) - frozen if taken_over else None,
+            "dispatched_by_new_leader": len(taken_over),
+            "lost": len(tasks) - len(lags),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run, default all of {', '.join(SCENARIOS)}")
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--delay", type=float, default=0.0, help="response delay of fast target in seconds")
+    parser.add_argument("--slow-delay", type=float, default=2.0, help="response delay of slow target in seconds")
+    parser.add_argument("--slow-fraction", type=float, default=0.1, help="share of jobs targeting slow host")
+    parser.add_argument("--lead", type=float, default=5.0, help="min seconds between instance start and tick")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for jobs after their planned time")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE passed to every instance")
+    parser.add_argument("--output", help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    bench = Bench(args)
+    results = []
+    for scenario in args.scenarios or SCENARIOS:
+        started = time.time()
+        result = getattr(bench, scenario)()
+        results.append(
+            dict(
+                {"scenario": scenario, "started": datetime.datetime.fromtimestamp(started).isoformat(), "env": bench.overrides},
+                **result,
+            )
+        )
+        print(f"{scenario} done in {time.time() - started:.0f}s", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Compare APScheduler and heap scheduler cores on large workloads
+
+Usage: python bench_scheduler.py [--jobs 50000] [--schedules 100] [--fire] [--output results.json]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from apscheduler.executors.pool import ThreadPoolExecutor  # noqa: E402
+from apscheduler.schedulers.background import BackgroundScheduler  # noqa: E402
+
+import cdcron  # noqa: E402
+import cronheap  # noqa: E402
+import workload  # noqa: E402
+
+
+def generate_workload(jobs, schedules):
+    """Tasks spread over given number of distinct every-minute-ish crontabs"""
+
+    crons = ["* * * * *"] + [f"{i % 60} {i // 60 % 24}-23 * * *" for i in range(1, schedules)]
+    return [
+        {"method": "GET", "cron": crons[i % len(crons)], "url": f"http://127.0.0.1/{i}", "id": str(i)}
+        for i in range(jobs)
+    ]
+
+
+def build(core, workers):
+    if core == "heap":
+        return cronheap.HeapScheduler(max_workers=workers, misfire_grace_time=30)
+    return BackgroundScheduler(
+        executors={"default": ThreadPoolExecutor(workers)},
+        job_defaults={"misfire_grace_time": 30},
+    )
+
+
+def run(core, tasks, workers, fire):
+    # Jobs due at the next minute boundary
+    now = datetime.datetime.now()
+    boundary = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    masks = {cron: cronheap.CronMask(*cron.split()) for cron in {task["cron"] for task in tasks}}
+    due = sum(1 for task in tasks if masks[task["cron"]].next_fire_time(now) == boundary)
+
+    fired = []
+    done = threading.Event()
+
+    def noop(task, planned=None):
+        fired.append(time.monotonic())
+        if len(fired) == due:
+            done.set()
+
+    result = {"core": core, "jobs": len(tasks)}
+
+    workload.cron_trigger.cache_clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    jobs = workload.compile_jobs(tasks, {"GET": noop})
+    result["compile_seconds"] = time.perf_counter() - started
+
+    scheduler = build(core, workers)
+    started = time.perf_counter()
+    cdcron.sync_jobs(scheduler, {"GET": noop}, {}, jobs)
+    scheduler.start()
+    result["schedule_seconds"] = time.perf_counter() - started
+    result["memory_bytes"] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if fire:
+        # Wait for next minute boundary and measure how long it takes to dispatch every job due
+        done.wait((boundary - datetime.datetime.now()).total_seconds() + 60)
+        tick = time.monotonic() - (time.time() - boundary.timestamp())
+        result["due_jobs"] = due
+        result["dispatched_jobs"] = len(fired)
+        if fired:
+            result["first_dispatch_lag_seconds"] = min(fired) - tick
+            result["last_dispatch_lag_seconds"] = max(fired) - tick
+
+    scheduler.shutdown(wait=False)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=50000)
+    parser.add_argument("--schedules", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--fire", action="store_true", help="wait for next minute and measure tick dispatch")
+    parser.add_argument("--output", help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("cdcron").setLevel(logging.WARNING)
+
+    tasks = generate_workload(args.jobs, args.schedules)
+    results = [run(core, tasks, args.workers, args.fire) for core in ("apscheduler", "heap")]
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
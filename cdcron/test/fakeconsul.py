@@ -0,0 +1,432 @@
+"""In-process stand-in for the Consul HTTP endpoints used by cdcron"""
+
+import argparse
+import base64
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def _duration(value, default):
+    """Parse Consul duration string like '15s' or '10m' into seconds"""
+
+    if not value:
+        return default
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)(ms|s|m|h)?", value)
+    if not match:
+        return default
+    number, unit = float(match.group(1)), match.group(2) or "s"
+    return number * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+class State:
+    """Catalog, sessions and KV store guarded by one condition variable"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.index = 1
+        self.tables = {"kv": 1, "catalog": 1, "session": 1}
+        self.services = {}
+        self.checks = {}
+        self.sessions = {}
+        self.kv = {}
+        self.requests = 0
+
+    def bump(self, table):
+        self.index += 1
+        self.tables[table] = self.index
+        self.cond.notify_all()
+        return self.index
+
+    def wait(self, table, index, wait):
+        """Block until table index is greater than index or wait expires"""
+
+        deadline = time.monotonic() + wait
+        while index and self.tables[table] <= index:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self.cond.wait(remaining)
+
+    def invalidate(self, session_id):
+        """Destroy session and apply its behavior to held locks"""
+
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            return
+        for key, entry in list(self.kv.items()):
+            if entry.get("Session") == session_id:
+                if session["Behavior"] == "delete":
+                    del self.kv[key]
+                else:
+                    entry.pop("Session", None)
+                    entry["ModifyIndex"] = self.index + 1
+        self.bump("session")
+        self.bump("kv")
+
+    def reap(self):
+        """Fail TTL checks that were not updated in time, invalidate sessions whose TTL expired or whose checks are critical"""
+
+        now = time.monotonic()
+        for check in self.checks.values():
+            if check.get("TTL") and check["Status"] != "critical" and now > check["expires"]:
+                check["Status"] = "critical"
+                check["Output"] = "TTL expired"
+                self.bump("catalog")
+        for session_id, session in list(self.sessions.items()):
+            expired = session["TTL"] and now > session["expires"]
+            failed = any(self.checks.get(check, {}).get("Status") == "critical" for check in session["Checks"])
+            if expired or failed:
+                self.invalidate(session_id)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are written separately, reused connection must not wait for delayed ACK
+
+    def log_message(self, format, *args):
+        return
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _reply(self, status, body=None, index=None):
+        payload = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if index is not None:
+            self.send_header("X-Consul-Index", str(index))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _route(self, verb):
+        parts = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        body = self._body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.state.cond:
+            self.state.requests += 1
+            for pattern, handler in ROUTES:
+                match = re.fullmatch(pattern, parts.path)
+                if match and handler.__name__.startswith(verb.lower()):
+                    return handler(self, query, body, *match.groups())
+        self._reply(404)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    # Agent
+
+    def put_register(self, query, body):
+        service = json.loads(body)
+        service_id = service.get("ID") or service["Name"]
+        self.state.services[service_id] = service
+        check = service.get("Check") or {}
+        status = "critical" if "TTL" in check else "passing"
+        ttl = _duration(check.get("TTL"), 0)
+        self.state.checks[check.get("CheckID", f"service:{service_id}")] = {
+            "ServiceID": service_id,
+            "Status": check.get("Status", status),
+            "Output": "",
+            "TTL": ttl,
+            "expires": time.monotonic() + ttl,
+        }
+        self.state.bump("catalog")
+        self._reply(200)
+
+    def put_deregister(self, query, body, service_id):
+        if self.state.services.pop(service_id, None) is None:
+            return self._reply(404)
+        for check_id in [key for key, check in self.state.checks.items() if check["ServiceID"] == service_id]:
+            del self.state.checks[check_id]
+        self.state.bump("catalog")
+        self._reply(200)
+
+    def put_check_update(self, query, body, check_id):
+        check = self.state.checks.get(check_id)
+        if check is None:
+            return self._reply(404)
+        update = json.loads(body or b"{}")
+        check["Status"] = update.get("Status", "passing")
+        check["Output"] = update.get("Output", "")
+        check["expires"] = time.monotonic() + check["TTL"]
+        self.state.bump("catalog")
+        self._reply(200)
+
+    # Catalog and health
+
+    def _instances(self, name):
+        return [(service_id, service) for service_id, service in self.state.services.items() if service["Name"] == name]
+
+    def get_catalog_service(self, query, body, name):
+        self.state.wait("catalog", int(query.get("index", 0)), _duration(query.get("wait"), 300))
+        result = [{"ServiceID": service_id, "ServiceName": name} for service_id, _ in self._instances(name)]
+        self._reply(200, result, self.state.tables["catalog"])
+
+    def get_health_service(self, query, body, name):
+        self.state.wait("catalog", int(query.get("index", 0)), _duration(query.get("wait"), 300))
+        result = []
+        for service_id, service in self._instances(name):
+            checks = [
+                {"CheckID": check_id, "ServiceID": service_id, "Status": check["Status"], "Output": check["Output"]}
+                for check_id, check in self.state.checks.items()
+                if check["ServiceID"] == service_id
+            ]
+            if "passing" in query and any(check["Status"] != "passing" for check in checks):
+                continue
+            result.append({"Service": {"ID": service_id, "Service": name}, "Checks": checks})
+        self._reply(200, result, self.state.tables["catalog"])
+
+    # Sessions
+
+    def put_session_create(self, query, body):
+        request = json.loads(body or b"{}")
+        session_id = str(uuid.uuid4())
+        ttl = _duration(request.get("TTL"), 0)
+        checks = [check["ID"] for check in request.get("ServiceChecks", [])]
+        if any(self.state.checks.get(check, {}).get("Status", "critical") == "critical" for check in checks):
+            return self._reply(500, f"check of session is missing or in critical state: {checks}")
+        self.state.sessions[session_id] = {
+            "TTL": ttl,
+            "expires": time.monotonic() + ttl * 2,  # Consul grants 2x TTL grace
+            "Behavior": request.get("Behavior", "release"),
+            "Checks": checks,
+        }
+        self.state.bump("session")
+        self._reply(200, {"ID": session_id})
+
+    def put_session_renew(self, query, body, session_id):
+        session = self.state.sessions.get(session_id)
+        if session is None:
+            return self._reply(404)
+        session["expires"] = time.monotonic() + session["TTL"] * 2
+        self._reply(200, [{"ID": session_id, "TTL": f"{session['TTL']:g}s"}])
+
+    def get_session_info(self, query, body, session_id):
+        session = self.state.sessions.get(session_id)
+        self._reply(200, [{"ID": session_id, "ServiceChecks": [{"ID": check} for check in session["Checks"]]}] if session else [])
+
+    def put_session_destroy(self, query, body, session_id):
+        self.state.invalidate(session_id)
+        self._reply(200, True)
+
+    # KV
+
+    def _entry(self, key, entry):
+        value = entry.get("Value")
+        return {
+            "Key": key,
+            "Value": base64.b64encode(value).decode("ascii") if value is not None else None,
+            "Session": entry.get("Session"),
+            "ModifyIndex": entry["ModifyIndex"],
+            "CreateIndex": entry["CreateIndex"],
+            "LockIndex": entry.get("LockIndex", 0),
+            "Flags": 0,
+        }
+
+    def get_kv(self, query, body, key):
+        self.state.wait("kv", int(query.get("index", 0)), _duration(query.get("wait"), 300))
+        index = self.state.tables["kv"]
+        if "recurse" in query:
+            entries = [self._entry(k, e) for k, e in sorted(self.state.kv.items()) if k.startswith(key)]
+        else:
+            entries = [self._entry(key, self.state.kv[key])] if key in self.state.kv else []
+        if not entries:
+            return self._reply(404, index=index)
+        if "raw" in query:
+            return self._reply(200, json.loads(self.state.kv[key]["Value"]), index)
+        self._reply(200, entries, index)
+
+    def _set(self, key, value, session=None, acquire=False, release=False, cas=None):
+        """Apply KV write, returns False when lock or CAS check fails"""
+
+        entry = self.state.kv.get(key)
+        if cas is not None and (entry["ModifyIndex"] if entry else 0) != cas:
+            return False
+        if acquire:
+            if session not in self.state.sessions:
+                return False
+            if entry and entry.get("Session") not in (None, session):
+                return False
+        if release and (not entry or entry.get("Session") != session):
+            return False
+        index = self.state.index + 1
+        if entry is None:
+            entry = {"CreateIndex": index}
+            self.state.kv[key] = entry
+        entry["Value"] = value
+        entry["ModifyIndex"] = index
+        if acquire and entry.get("Session") != session:
+            entry["Session"] = session
+            entry["LockIndex"] = entry.get("LockIndex", 0) + 1
+        elif release:
+            entry.pop("Session", None)
+        self.state.bump("kv")
+        return True
+
+    def put_kv(self, query, body, key):
+        cas = int(query["cas"]) if "cas" in query else None
+        if "acquire" in query:
+            result = self._set(key, body, query["acquire"], acquire=True, cas=cas)
+        elif "release" in query:
+            result = self._set(key, body, query["release"], release=True, cas=cas)
+        else:
+            result = self._set(key, body, cas=cas)
+        self._reply(200, result)
+
+    def delete_kv(self, query, body, key):
+        if "recurse" in query:
+            keys = [k for k in self.state.kv if k.startswith(key)]
+        else:
+            keys = [key] if key in self.state.kv else []
+        for k in keys:
+            del self.state.kv[k]
+        if keys:
+            self.state.bump("kv")
+        self._reply(200, True)
+
+    # Transactions
+
+    def put_txn(self, query, body):
+        operations = json.loads(body)
+        results, errors = [], []
+        snapshot = {key: dict(entry) for key, entry in self.state.kv.items()}
+        indexes = self.state.index, dict(self.state.tables)
+        for position, operation in enumerate(operations):
+            kv = operation.get("KV")
+            if kv is None:
+                errors.append({"OpIndex": position, "What": "only KV operations are supported"})
+                continue
+            verb, key = kv["Verb"], kv["Key"]
+            value = base64.b64decode(kv["Value"]) if kv.get("Value") else None
+            entry = self.state.kv.get(key)
+            if verb == "get":
+                if entry is None:
+                    errors.append({"OpIndex": position, "What": f'key "{key}" doesn\'t exist'})
+                else:
+                    results.append({"KV": self._entry(key, entry)})
+            elif verb == "set":
+                self._set(key, value)
+                results.append({"KV": self._entry(key, self.state.kv[key])})
+            elif verb == "lock":
+                if self._set(key, value, kv["Session"], acquire=True):
+                    results.append({"KV": self._entry(key, self.state.kv[key])})
+                else:
+                    errors.append({"OpIndex": position, "What": f'failed to lock key "{key}"'})
+            elif verb == "unlock":
+                if not entry or entry.get("Session") != kv["Session"]:
+                    errors.append({"OpIndex": position, "What": f'key "{key}" is not locked by session'})
+                else:
+                    entry.pop("Session", None)
+                    entry["ModifyIndex"] = self.state.bump("kv")
+                    results.append({"KV": self._entry(key, entry)})
+            elif verb == "check-session":
+                if not entry or entry.get("Session") != kv["Session"]:
+                    errors.append({"OpIndex": position, "What": f'key "{key}" is not locked by session'})
+            elif verb == "delete":
+                self.state.kv.pop(key, None)
+                self.state.bump("kv")
+            else:
+                errors.append({"OpIndex": position, "What": f"unsupported verb {verb}"})
+        if errors:
+            # Rolled back transaction leaves no trace, watchers are not woken up
+            self.state.kv = snapshot
+            self.state.index, self.state.tables = indexes
+            return self._reply(409, {"Results": None, "Errors": errors})
+        self._reply(200, {"Results": results, "Errors": None})
+
+
+ROUTES = [
+    (r"/v1/agent/service/register", Handler.put_register),
+    (r"/v1/agent/service/deregister/(.+)", Handler.put_deregister),
+    (r"/v1/agent/check/update/(.+)", Handler.put_check_update),
+    (r"/v1/catalog/service/(.+)", Handler.get_catalog_service),
+    (r"/v1/health/service/(.+)", Handler.get_health_service),
+    (r"/v1/session/create", Handler.put_session_create),
+    (r"/v1/session/renew/(.+)", Handler.put_session_renew),
+    (r"/v1/session/destroy/(.+)", Handler.put_session_destroy),
+    (r"/v1/session/info/(.+)", Handler.get_session_info),
+    (r"/v1/kv/(.*)", Handler.get_kv),
+    (r"/v1/kv/(.*)", Handler.put_kv),
+    (r"/v1/kv/(.*)", Handler.delete_kv),
+    (r"/v1/txn", Handler.put_txn),
+]
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)  # Clients killed mid-request are expected
+
+
+class FakeConsul:
+    """Fake Consul agent listening on localhost, run in background thread"""
+
+    def __init__(self, port=0, latency=0.0):
+        self.state = State()
+        self.server = Server(("127.0.0.1", port), Handler)
+        self.server.state = self.state
+        self.server.latency = latency
+        self.port = self.server.server_address[1]
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._reaper, daemon=True).start()
+        return self
+
+    def _reaper(self):
+        while not self._stopped.wait(0.05):
+            with self.state.cond:
+                self.state.reap()
+
+    def stop(self):
+        self._stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        """Forget all services, sessions and keys, blocking queries in flight still see old state"""
+
+        self.state = self.server.state = State()
+
+    def leader_session(self, service_name="cdcron"):
+        with self.state.cond:
+            entry = self.state.kv.get(f"service/{service_name}/leader")
+            return entry.get("Session") if entry else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+
+    consul = FakeConsul(args.port, args.latency).start()
+    print(f"fake consul listening on 127.0.0.1:{consul.port}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Fast local target recording arrival of every request
+
+Usage: python target.py [--port 8000] [--delay 0]
+"""
+
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FENCING_HEADER = "X-Cdcron-Fencing-Token"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # Headers and body are written separately, reused connection must not wait for delayed ACK
+
+    def log_message(self, format, *args):
+        return
+
+    def _handle(self):
+        target = self.server.target
+        arrived = time.time()
+        target.enter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length:
+                self.rfile.read(length)
+            if target.delay:
+                time.sleep(target.delay)
+            self.send_response(target.status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(b"ok")
+        finally:
+            target.leave(arrived, self.command, self.path, self.headers.get(FENCING_HEADER))
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_TRACE = _handle
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class Target:
+    """Target server answering every request with status after delay, run in background thread"""
+
+    def __init__(self, port=0, delay=0.0, status=200):
+        self.delay = delay
+        self.status = status
+        self.requests = []  # Arrival timestamp, method, path and fencing token of every finished request
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self.server = Server(("127.0.0.1", port), Handler)
+        self.server.target = self
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def enter(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def leave(self, arrived, method, path, token):
+        with self._lock:
+            self.active -= 1
+            self.requests.append((arrived, method, path, token))
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+            self.peak = self.active
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before responding")
+    parser.add_argument("--status", type=int, default=200)
+    args = parser.parse_args()
+
+    target = Target(args.port, args.delay, args.status).start()
+    print(f"target listening on {target.url}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()